@@ -1,23 +1,32 @@
+import glob
+
 import torch
 import matplotlib.pyplot as plt
 
-eul = torch.load("weights/results_aircraft_eul.pt", map_location=torch.device("cpu"))
-eul_flat = eul.ravel()
-eul_flat_sort, _ = torch.sort(eul_flat)
+from quantile_sketch import QuantileSketch, load_sketches, percentile_row
+
+
+def angle_sketch(diff_type):
+    '''Merged angle sketch of all result shards, falling back to the raw angles of older runs
+    '''
+    paths = sorted(glob.glob(f"weights/results_aircraft_{diff_type}_sketch*.pt"))
+    if paths:
+        return load_sketches(*paths)["angle"]
+    angles = torch.load(f"weights/results_aircraft_{diff_type}.pt", map_location=torch.device("cpu"))
+    return QuantileSketch().update(angles)
+
 
-so3 = torch.load("weights/results_aircraft_so3.pt", map_location=torch.device("cpu"))
-so3_flat = so3.ravel()
-so3_flat_sort, _ = torch.sort(so3_flat)
+eul = angle_sketch("eul")
+so3 = angle_sketch("so3")
 
-plt.plot(eul_flat_sort.numpy(), label="euler")
-plt.plot(so3_flat_sort.numpy(), label="so3")
+levels = torch.linspace(0, 1, 1001)
+plt.plot(levels.numpy(), eul.quantile(levels).numpy(), label="euler")
+plt.plot(levels.numpy(), so3.quantile(levels).numpy(), label="so3")
 plt.legend()
 plt.show()
 
-count = len(so3_flat_sort)
-print(count)
+print(so3.count)
 percentiles = (0.01, 0.05, 0.10, 0.50, 0.90, 0.95,  0.99)
-per_idxs = [int(count * p) for p in percentiles]
 print("percentiles", *[f" & {p:.0%}" for p in  percentiles],r"\\")
-print("euler", *[f" & {eul_flat_sort[i].item():.2f}" for i in per_idxs],r"\\")
-print("so3", *[f" & {so3_flat_sort[i].item():.2f}" for i in per_idxs],r"\\")
+print(percentile_row("euler", eul, percentiles))
+print(percentile_row("so3", so3, percentiles))
@@ -0,0 +1,31 @@
+import shutil
+import subprocess
+import sys
+
+import torch
+
+from results_store import ResultsReader
+
+ITEMS = 4
+
+
+def run(store_path, *args):
+    '''Runs aircraft_test on the first ITEMS test items from a clean store, returns the merged poses
+    '''
+    shutil.rmtree(store_path, ignore_errors=True)
+    shutil.rmtree(f"{store_path}_shards", ignore_errors=True)
+    subprocess.run([sys.executable, "aircraft_test.py", "--batch", "1", "--limit", str(ITEMS), *args], check=True)
+    return ResultsReader(store_path).all_poses().rot
+
+
+if __name__ == "__main__":
+    # Same arguments as aircraft_test, e.g. --so3, passed through to both runs
+    args = sys.argv[1:]
+    diff_type = "so3" if "--so3" in args else "eul"
+    store_path = f"weights/results_aircraft_{diff_type}_limit{ITEMS}"
+    # Blocks are seeded by block_seed, so two pool workers must give exactly the single process samples
+    sharded = run(store_path, "--workers", "2", *args)
+    single = run(store_path, "--workers", "1", *args)
+    if len(sharded) != ITEMS or not torch.equal(sharded, single):
+        raise RuntimeError(f"--workers 2 gave different samples to --workers 1 on {ITEMS} items")
+    print(f"--workers 2 matches --workers 1 on {ITEMS} items")
@@ -1,13 +1,122 @@
+import json
+import multiprocessing
+import os
+import shutil
+import time
+
 from tqdm import tqdm, trange
 from torch.utils.data import DataLoader
 
 from datasets import ShapeNet
 from diffusion import ProjectedSO3Diffusion, ProjectedGaussianDiffusion
 from models import PointCloudProj, PlaneNet
+from quantile_sketch import QuantileSketch, save_sketches
+from results_store import ResultsWriter, ResultsReader, merge_results
 from util import *
 
 SAMPLES = 8
 
+
+def block_seed(seed, block):
+    '''RNG seed of a block of the test set, so samples don't depend on which shard ran it
+    '''
+    return (seed << 32) + block
+
+
+def sample_block(process, proj, data, so3, device):
+    '''SAMPLES rotations for each point cloud in data (b, n, 3), returns rotation matrices (b, SAMPLES, 3, 3)
+    '''
+    b = len(data)
+    # One projection module per shard, with the point clouds swapped in per block
+    proj.data = data.to(device)
+    process.projection = proj
+    results = torch.zeros((b, SAMPLES, 3, 3)).to(device)
+    for samp in trange(SAMPLES, leave=False, desc="sample number"):
+        with torch.no_grad():
+            # Initial Haar-Uniform random rotations from QR decomp of normal IID matrix
+            R, _ = torch.linalg.qr(torch.randn((b, 3, 3)), "reduced")
+            if not so3:
+                R = torch.stack(rmat_to_euler(R), dim=-1)
+            R = R.to(device)
+            for i in tqdm(reversed(range(0, process.num_timesteps)),
+                          desc='sampling loop time step',
+                          total=process.num_timesteps,
+                          leave=False,
+                          ):
+                R = process.p_sample(R, torch.full((b,), i, device=device, dtype=torch.long)).detach()
+        if not so3:
+            results[:, samp] = euler_to_rmat(*torch.unbind(R, -1))
+        else:
+            results[:, samp] = R
+    return results
+
+
+def shard_blocks(num_items, batch, shard, num_shards):
+    '''Blocks of `batch` consecutive test items, dealt round robin to the shards, as {block: item indices}
+    '''
+    starts = range(0, num_items, batch)
+    return {b: list(range(s, min(s + batch, num_items))) for b, s in enumerate(starts) if b % num_shards == shard}
+
+
+def run_shard(net, config, shard, num_shards, shard_dir):
+    '''Samples every block of the shard not already in its store, appending each block as it finishes
+
+    The net is shared read only between worker processes, each block is seeded by block_seed
+    and blocks are written whole, so a rerun skips finished blocks and gives the same samples.
+    '''
+    if torch.cuda.is_available():
+        device = torch.device(f"cuda:{shard % torch.cuda.device_count()}")
+    else:
+        device = torch.device("cpu")
+    so3 = config['so3']
+    ds = ShapeNet('test', (0,))
+    num_items = len(ds) if config['limit'] is None else min(config['limit'], len(ds))
+    blocks = shard_blocks(num_items, config['batch'], shard, num_shards)
+    store_path = os.path.join(shard_dir, f"shard_{shard}")
+    done = set()
+    if os.path.exists(os.path.join(store_path, "meta.i64")):
+        done = set(ResultsReader(store_path).column("item").tolist())
+    todo = [b for b, items in blocks.items() if items[0] not in done]
+    if not todo:
+        return shard, 0, 0.0
+    net = net.to(device)
+    if so3:
+        process = ProjectedSO3Diffusion(net).to(device)
+    else:
+        process = ProjectedGaussianDiffusion(net).to(device)
+    proj = PointCloudProj(None, so3=so3).to(device)
+    # Pool workers are daemonic and can't start loader processes of their own, so they load in process
+    num_workers = 0 if multiprocessing.current_process().daemon else 2
+    dl = DataLoader(ds, batch_sampler=[blocks[b] for b in todo], num_workers=num_workers, pin_memory=True)
+
+    elapsed = 0.0
+    with ResultsWriter(store_path, SAMPLES, seed=config['seed']) as writer:
+        for block, data in zip(todo, tqdm(dl, desc=f'shard {shard} batch', position=shard)):
+            start = time.perf_counter()
+            torch.manual_seed(block_seed(config['seed'], block))
+            results = sample_block(process, proj, data, so3, device)
+            writer.append(results, items=torch.tensor(blocks[block]))
+            elapsed += time.perf_counter() - start
+    items = sum(len(blocks[b]) for b in todo)
+    return shard, items, elapsed
+
+
+def check_run_config(shard_dir, config, num_shards):
+    '''Shards can only be resumed with the same blocks and seeds, so record these with the shards
+    '''
+    run = {"batch": config['batch'], "seed": config['seed'], "num_shards": num_shards, "limit": config['limit']}
+    path = os.path.join(shard_dir, "run.json")
+    if os.path.exists(path):
+        with open(path) as f:
+            saved = json.load(f)
+        if saved != run:
+            raise RuntimeError(f"Shards in {shard_dir} were run with {saved}, not {run}")
+    else:
+        os.makedirs(shard_dir, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(run, f)
+
+
 if __name__ == "__main__":
     import argparse
 
@@ -45,55 +154,74 @@ if __name__ == "__main__":
         help="Use SO3 diffusion rather than euler angles",
         )
 
-    args = parser.parse_args()
-
-    device = torch.device(f"cuda") if torch.cuda.is_available() else torch.device("cpu")
-    ds = ShapeNet('test', (0,))
-    dl = DataLoader(ds, batch_size=args.batch, shuffle=False, num_workers=4, pin_memory=True, persistent_workers=True)
-    res = torch.zeros((len(ds), SAMPLES))
+    parser.add_argument(
+        "--seed", type=int, default=0, help="base random seed, each block of the test set is seeded from it"
+        )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="number of worker processes, one per shard"
+        )
+    parser.add_argument(
+        "--num_shards", type=int, default=None, help="number of shards to split the test set into (default: workers)"
+        )
+    parser.add_argument(
+        "--shard", type=int, default=None, help="only run this shard, e.g. from a job array, and don't merge"
+        )
+    parser.add_argument(
+        "--limit", type=int, default=None, help="only test the first n items, e.g. for a quick check of --workers 2"
+        )
 
+    args = parser.parse_args()
     config = vars(args)
-    net, = init_from_dict(config, PlaneNet)
-    net.to(device)
+    num_shards = args.num_shards if args.num_shards is not None else args.workers
     diff_type = "so3" if config['so3'] else "eul"
     weight_path = f"weights/weights_aircraft_{diff_type}.pt"
-    net.load_state_dict(torch.load(weight_path, map_location=device))
+    store_path = f"weights/results_aircraft_{diff_type}"
+    if args.limit is not None:
+        store_path += f"_limit{args.limit}"
+    shard_dir = f"{store_path}_shards"
+    check_run_config(shard_dir, config, num_shards)
+
+    # Weights are loaded once, into shared memory the worker processes read from
+    net, = init_from_dict(config, PlaneNet)
+    net.load_state_dict(torch.load(weight_path, map_location=torch.device("cpu")))
     net.eval()
-    if config['so3']:
-        process = ProjectedSO3Diffusion(net).to(device)
-        truepos = process.identity
-        truepos_repeat = truepos.repeat(config['batch'], 1, 1)
+    net.share_memory()
+
+    shards = range(num_shards) if args.shard is None else [args.shard]
+    tasks = [(net, config, shard, num_shards, shard_dir) for shard in shards]
+    if args.workers > 1:
+        import torch.multiprocessing as mp
+        mp.set_start_method('spawn')  # need so cuda can be used in multiple processes
+        with mp.Pool(processes=args.workers) as pool:
+            stats = pool.starmap(run_shard, tasks)
     else:
-        process = ProjectedGaussianDiffusion(net).to(device)
-        truepos = torch.zeros(3).to(device)
-        truepos_repeat = truepos.repeat(config['batch'], 1)
-
-    for b, data in enumerate(tqdm(dl, desc='batch')):
-        proj = PointCloudProj(data.to(device), so3=config['so3']).to(device)
-        process.projection = proj
-
-        results = torch.zeros((args.batch, SAMPLES, 3, 3)).to(device)
-
-        for samp in trange(SAMPLES, leave=False, desc="sample number"):
-            with torch.no_grad():
-                # Initial Haar-Uniform random rotations from QR decomp of normal IID matrix
-                R, _ = torch.linalg.qr(torch.randn((args.batch, 3, 3)), "reduced")
-                if not config['so3']:
-                    R = torch.stack(rmat_to_euler(R),dim=-1)
-                R = R.to(device)
-                for i in tqdm(reversed(range(0, process.num_timesteps)),
-                              desc='sampling loop time step',
-                              total=process.num_timesteps,
-                              leave=False,
-                              ):
-                    R = process.p_sample(R, torch.full((args.batch,), i, device=device, dtype=torch.long)).detach()
-            if not config['so3']:
-                results[:, samp] = euler_to_rmat(*torch.unbind(R,-1))
-            else:
-                results[:, samp] = R
-
-        axis, angle = rmat_to_aa(results)
-        start = b * args.batch
-        end = start + len(angle)
-        res[start:end] = angle.detach().cpu().squeeze()
-    torch.save(res, f"weights/results_aircraft_{diff_type}.pt")
\ No newline at end of file
+        stats = [run_shard(*task) for task in tasks]
+    for shard, items, elapsed in stats:
+        if items:
+            print(f"shard {shard}: {items} items in {elapsed:.1f}s, "
+                  f"{items / elapsed:.3f} items/s, {items * SAMPLES / elapsed:.3f} samples/s")
+        else:
+            print(f"shard {shard}: already complete")
+    if args.shard is not None:
+        exit()
+
+    # Rows are merged in order of test item, so the store is the same however the work was sharded
+    shard_paths = [os.path.join(shard_dir, f"shard_{shard}") for shard in range(num_shards)]
+    shutil.rmtree(store_path, ignore_errors=True)
+    merge_results(store_path, *shard_paths, sort_by="item")
+    reader = ResultsReader(store_path)
+    num_items = len(ShapeNet('test', (0,)))
+    if args.limit is not None:
+        num_items = min(args.limit, num_items)
+    if len(reader) != num_items:
+        raise RuntimeError(f"Merged {len(reader)} items, some shards are incomplete")
+
+    sketches = {"angle": QuantileSketch(generator=torch.Generator().manual_seed(args.seed))}
+    for poses, _ in reader.chunks():
+        axis, angle = rmat_to_aa(poses.rot)
+        sketches["angle"].update(angle)
+    save_sketches(sketches, f"{store_path}_sketch.pt")
+    # Every target is the identity, so compare all samples to a point mass there
+    rots = reader.all_poses().rot
+    sw = sliced_wasserstein(rots.flatten(0, 1), torch.eye(3)[None])
+    print(f"sliced wasserstein to identity: {sw.item():.4f}")
@@ -0,0 +1,131 @@
+import csv
+import glob
+import os
+import re
+import time
+
+import torch
+from bingham_train import covpairs, RotPredict, loc
+from bingham_test import SAMPLES, NET_SAMPLES, NET_RUNS, NUM_FEATURES, reference_mmd
+from distributions import Bingham
+from diffusion import SO3Diffusion
+from util import *
+
+COLUMNS = ("step", "mmd", "mmd_unbiased", "seconds")
+
+device = torch.device(f"cuda") if torch.cuda.is_available() else torch.device("cpu")
+
+
+def checkpoint_steps(acro):
+    '''Training steps of all saved checkpoints for a covariance, in order
+    '''
+    pattern = re.compile(rf"weights_bing_{acro}_(\d+)\.pt$")
+    matches = [pattern.search(path) for path in glob.glob(f"weights/weights_bing_{acro}_*.pt")]
+    return sorted(int(m.group(1)) for m in matches if m)
+
+
+def reference_set(acro, cov, seed=0):
+    '''Bingham reference samples and their kernel self-sum, sampled and summed once then cached on disk
+    '''
+    path = f"weights/bingham_ref_{acro}_{seed}.pt"
+    if os.path.exists(path):
+        ref = torch.load(path, map_location=device)
+        return ref["samples"], ref["X_sum"]
+    torch.manual_seed(seed)
+    bing = Bingham(loc=loc.to(device), covariance_matrix=cov.to(device))
+    samples = quat_to_rmat(bing.sample((SAMPLES,)))
+    X_sum = StreamingMMD(samples, rmat_gaussian_kernel, chunksize="auto").X_sum
+    torch.save({"samples": samples.cpu(), "X_sum": X_sum.cpu()}, path)
+    return samples, X_sum
+
+
+# Reference of the worker process, loaded once by init_worker rather than per checkpoint
+_reference = None
+
+
+def init_worker(acro, cov, num_features, seed):
+    global _reference
+    if num_features:
+        _reference = reference_mmd(acro, cov, num_features, seed)
+    else:
+        _reference = reference_set(acro, cov, seed)
+
+
+def eval_step(acro, step, num_features, seed):
+    '''MMD of one checkpoint's samples against the worker's reference, only computing the new kernel blocks
+    '''
+    start = time.perf_counter()
+    net = RotPredict(out_type="skewvec").to(device)
+    net.load_state_dict(torch.load(f"weights/weights_bing_{acro}_{step}.pt", map_location=device))
+    diff = SO3Diffusion(net, loss_type="skewvec").to(device)
+    if num_features:
+        mmd = _reference
+        mmd.reset()
+    else:
+        samples, X_sum = _reference
+        mmd = StreamingMMD(samples, rmat_gaussian_kernel, chunksize="auto", X_sum=X_sum)
+    torch.manual_seed(seed + step)
+    for i in range(NET_RUNS):
+        mmd.update(diff.p_sample_loop((NET_SAMPLES,)))
+    # The random feature estimate has no unbiased form, so it's reported for both
+    unbiased = mmd.result() if num_features else mmd.unbiased_result()
+    return {"step": step, "mmd": mmd.result().item(), "mmd_unbiased": unbiased.item(),
+            "seconds": time.perf_counter() - start}
+
+
+def eval_task(task):
+    return eval_step(*task)
+
+
+def finished_steps(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return {int(row["step"]) for row in csv.DictReader(f)}
+
+
+if __name__ == "__main__":
+    import argparse
+    import torch.multiprocessing as mp
+    mp.set_start_method('spawn') # need so cuda can be used in multiple threads
+    parser = argparse.ArgumentParser(description="Bingham checkpoint sweep args")
+    parser.add_argument(
+        "cov", type=str, help="covariance matrix to use", choices = ["sur", "scr", "lur", "lcr"]
+    )
+    parser.add_argument(
+        "--features", type=int, default=NUM_FEATURES, help="random features for approximate MMD, 0 for exact"
+    )
+    parser.add_argument(
+        "--stride", type=int, default=1, help="evaluate every n-th saved checkpoint"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=2, help="number of worker processes"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="seed of the reference samples and of each checkpoint's samples"
+    )
+    args = parser.parse_args()
+    acro = args.cov
+    cov, = [c for _, a, c in covpairs if a == acro]
+
+    # Build the cached reference once, before the workers load it
+    init_worker(acro, cov, args.features, args.seed)
+    # Seeds change both the reference and the checkpoint samples, so each gets its own table
+    table = f"bingham_sweep_{acro}_{args.features}_{args.seed}.csv"
+    done = finished_steps(table)
+    steps = [s for s in checkpoint_steps(acro)[::args.stride] if s not in done]
+    print(f"{len(steps)} checkpoints to evaluate, {len(done)} already in {table}")
+
+    new_table = not os.path.exists(table)
+    with open(table, "a", newline="") as f, \
+            mp.Pool(processes=args.workers, initializer=init_worker,
+                    initargs=(acro, cov, args.features, args.seed)) as pool:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        if new_table:
+            writer.writeheader()
+        # Rows are appended as each checkpoint finishes, so an interrupted sweep can be resumed
+        tasks = [(acro, step, args.features, args.seed) for step in steps]
+        for row in pool.imap_unordered(eval_task, tasks):
+            writer.writerow(row)
+            f.flush()
+            print(f"{row['step']}: mmd {row['mmd']:.5f} ({row['seconds']:.1f}s)")
@@ -1,33 +1,75 @@
+import os
+
 import torch
 from bingham_train import covpairs, RotPredict, loc
-from distributions import Bingham, IsotropicGaussianSO3
+from distributions import Bingham, IsotropicGaussianSO3, bingham_fit_report
 from diffusion import SO3Diffusion
+from so3_distill import load_distilled
 from util import *
 import pickle
 SAMPLES = 20_000
 NET_SAMPLES = 20_000
 NET_RUNS = SAMPLES//NET_SAMPLES
+# Random features for approximate MMD, 0 for exact
+NUM_FEATURES = 0
+# Samples per set for the permutation test, which holds the pooled kernel matrix
+PERM_SAMPLES = 2_000
+PERMUTATIONS = 500
 
 
 device = torch.device(f"cuda") if torch.cuda.is_available() else torch.device("cpu")
 
 
-def calc_step(acro, cov, step):
+def reference_mmd(acro, cov, num_features, seed=0):
+    '''Approximate MMD against Bingham samples, with the reference feature mean cached on disk
+
+    `seed` sets both the reference samples and the random features.
+    '''
+    path = f"weights/bingham_rff_{acro}_{num_features}_{seed}.pt"
+    if os.path.exists(path):
+        return RandomFeatureMMD.load(path, map_location=device)
+    torch.manual_seed(seed)
+    bing = Bingham(loc=loc.to(device), covariance_matrix=cov.to(device))
+    bing_samples = quat_to_rmat(bing.sample((SAMPLES,)))
+    mmd = RandomFeatureMMD(bing_samples, SO3RandomFeatures(num_features).to(device))
+    mmd.save(path)
+    return mmd
+
+
+def calc_step(acro, cov, step, num_features=NUM_FEATURES, distilled=None):
+    '''Evaluates the checkpoint at a training step, or with `distilled` set to its sampling steps,
+    the distilled checkpoint saved by so3_distill, sampled with its own step schedule
+    '''
     net = RotPredict(out_type="skewvec").to(device)
-    net.load_state_dict(torch.load(f"weights/weights_bing_{acro}_{step}.pt", map_location=device))
+    if distilled:
+        sample_steps = load_distilled(net, f"weights/weights_bing_{acro}_distill_{distilled}.pt", map_location=device)
+    else:
+        net.load_state_dict(torch.load(f"weights/weights_bing_{acro}_{step}.pt", map_location=device))
     diff = SO3Diffusion(net, loss_type="skewvec").to(device)
 
-    bing = Bingham(loc=loc.to(device), covariance_matrix=cov.to(device))
-    bing_samples = bing.sample((SAMPLES,))
-    bing_samples = quat_to_rmat(bing_samples)
-    diff_samples = []
+    if num_features:
+        mmd = reference_mmd(acro, cov, num_features)
+    else:
+        bing = Bingham(loc=loc.to(device), covariance_matrix=cov.to(device))
+        bing_samples = bing.sample((SAMPLES,))
+        bing_samples = quat_to_rmat(bing_samples)
+        # Stream each run's samples into the MMD sums, rather than holding every kernel block
+        mmd = StreamingMMD(bing_samples, rmat_gaussian_kernel, chunksize="auto")
+    samples = []
     for i in range(NET_RUNS):
-        R = diff.p_sample_loop((NET_SAMPLES,))
-        diff_samples.append(R)
-    diff_samples = torch.cat(diff_samples, dim=0)
-    print('aaaa')
-    mmd = MMD(bing_samples, diff_samples, rmat_gaussian_kernel, chunksize=4_000)
-    return mmd.item()
+        if distilled:
+            R = diff.ddim_sample_loop((NET_SAMPLES,), sample_steps)
+        else:
+            R = diff.p_sample_loop((NET_SAMPLES,))
+        mmd.update(R)
+        samples.append(R)
+    bing = Bingham(loc=loc.to(device), covariance_matrix=cov.to(device))
+    perm_test = MMDPermutationTest(quat_to_rmat(bing.sample((PERM_SAMPLES,))), R[:PERM_SAMPLES],
+                                   rmat_gaussian_kernel, chunksize=1_000)
+    sw = sliced_wasserstein(quat_to_rmat(bing.sample((SAMPLES,))), torch.cat(samples), use_quat=True)
+    fitted, fit_ll, ref_ll = bingham_fit_report(torch.cat(samples), bing)
+    fit = {"covariance": fitted.covariance_matrix.cpu(), "fitted_ll": fit_ll, "reference_ll": ref_ll}
+    return mmd.result().item(), perm_test.p_value(PERMUTATIONS), sw.item(), fit
 
 if __name__ == "__main__":
     import argparse
@@ -37,14 +79,31 @@ if __name__ == "__main__":
     parser.add_argument(
         "cov", type=str, help="covariance matrix to use", choices = ["sur", "scr", "lur", "lcr"]
     )
+    parser.add_argument(
+        "--features", type=int, default=NUM_FEATURES, help="random features for approximate MMD, 0 for exact"
+    )
+    parser.add_argument(
+        "--distilled", type=int, default=None, help="evaluate the distilled checkpoint with this many sampling steps"
+    )
     args = parser.parse_args()
     acro = args.cov
     cov, = [c for _, a, c in covpairs if a == acro]
     results = dict()
-    eval_points = [(acro, cov, step) for step in [100_000,]]
+    if args.features:
+        # Build the cached reference once, before the workers load it
+        reference_mmd(acro, cov, args.features)
+    eval_points = [(acro, cov, step, args.features, args.distilled) for step in [100_000,]]
     with mp.Pool(processes=2) as pool:
         p_results = pool.starmap(calc_step, eval_points)
-    for (acro, cov, step), mmd in zip(eval_points, p_results):
+    results["pvalues"] = dict()
+    results["sliced_wasserstein"] = dict()
+    results["bingham_fit"] = dict()
+    for (acro, cov, step, _, _), (mmd, p_value, sw, fit) in zip(eval_points, p_results):
         results[step] = mmd
+        results["pvalues"][step] = p_value
+        results["sliced_wasserstein"][step] = sw
+        results["bingham_fit"][step] = fit
+        print(f"{step}: log likelihood fitted {fit['fitted_ll']:.4f}, reference {fit['reference_ll']:.4f}")
     results["count"] = SAMPLES
-    pickle.dump(results, open(f'bingham_mmd_{acro}.pkl', 'wb'))
\ No newline at end of file
+    suffix = f"_distill_{args.distilled}" if args.distilled else ""
+    pickle.dump(results, open(f'bingham_mmd_{acro}{suffix}.pkl', 'wb'))
\ No newline at end of file
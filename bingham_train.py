@@ -1,7 +1,9 @@
 import torch.nn as nn
+import torch.nn.functional as F
 
+from denoising_diffusion_pytorch.denoising_diffusion_pytorch import extract
 from diffusion import SO3Diffusion
-from distributions import Bingham
+from distributions import Bingham, IsotropicGaussianSO3
 from models import SinusoidalPosEmb
 from util import *
 
@@ -47,6 +49,81 @@ class RotPredict(nn.Module):
         return out
 
 
+class StackedRotPredict(nn.Module):
+    '''K independent RotPredict models of the same shape, evaluated together as batched matmuls
+
+    Each linear layer's weights are stacked into a [K, in, out] parameter, so a forward and
+    backward pass over inputs [K, B, 3, 3] costs a few bmm calls rather than K small model calls.
+    Models don't share any parameters, so summing their losses gives each its own gradients.
+    '''
+
+    def __init__(self, models):
+        super().__init__()
+        self.out_type = models[0].out_type
+        self.time_embedding = models[0].time_embedding
+        # Names of the linear layers in RotPredict.net, for per-model state dicts
+        self.linear_names = [name for name, m in models[0].net.named_children() if isinstance(m, nn.Linear)]
+        linears = [[m for m in model.net if isinstance(m, nn.Linear)] for model in models]
+        self.weights = nn.ParameterList([nn.Parameter(torch.stack([l.weight.detach().t() for l in layer]))
+                                         for layer in zip(*linears)])
+        self.biases = nn.ParameterList([nn.Parameter(torch.stack([l.bias.detach()[None] for l in layer]))
+                                        for layer in zip(*linears)])
+
+    def __len__(self):
+        return len(self.weights[0])
+
+    def forward(self, x: torch.Tensor, t: torch.Tensor):
+        '''x of shape [K, B, 3, 3], t of shape [K, B]
+        '''
+        x_flat = torch.flatten(x, start_dim=-2)
+        t_emb = self.time_embedding(t.flatten()).reshape(t.shape + (-1,))
+        h = torch.cat((x_flat, t_emb), dim=-1)
+        for i, (w, b) in enumerate(zip(self.weights, self.biases)):
+            h = torch.baddbmm(b, h, w)
+            if i < len(self.weights) - 1:
+                h = F.silu(h)
+        if self.out_type == "rotmat":
+            h = six2rmat(h)
+        return h
+
+    def model_state_dict(self, k):
+        '''State dict of the k-th model, loadable into a RotPredict
+        '''
+        state = dict()
+        for name, w, b in zip(self.linear_names, self.weights, self.biases):
+            state[f"net.{name}.weight"] = w[k].detach().t().clone()
+            state[f"net.{name}.bias"] = b[k, 0].detach().clone()
+        return state
+
+
+def stacked_losses(process: SO3Diffusion, stacked: StackedRotPredict, x_start: torch.Tensor):
+    '''Skew vector denoising loss of each stacked model on its own batch, x_start of shape [K, B, 3, 3]
+
+    Matches SO3Diffusion.p_losses with loss_type "skewvec", with independent times and noise per sample.
+    '''
+    k, b = x_start.shape[:2]
+    t = torch.randint(0, process.num_timesteps, (k * b,), device=x_start.device).long()
+    eps = extract(process.sqrt_one_minus_alphas_cumprod, t, t.shape)
+    noise = IsotropicGaussianSO3(eps).sample()
+    x_noisy = process.q_sample(x_start=x_start.flatten(0, 1), t=t, noise=noise)
+    x_recon = stacked(x_noisy.reshape(k, b, 3, 3), t.reshape(k, b))
+    descaled_noise = skew2vec(log_rmat(noise)) * (1 / eps)[..., None]
+    return (x_recon - descaled_noise.reshape(k, b, 3)).pow(2).mean(dim=(1, 2))
+
+
+def stacked_adam_step(optim, stacked: StackedRotPredict, lrs: torch.Tensor):
+    '''Adam step with a learning rate per stacked model, `optim` being an Adam with lr=1
+
+    Without weight decay, an Adam update is linear in the learning rate, so the lr=1 update
+    is rescaled per model.
+    '''
+    before = [p.detach().clone() for p in stacked.parameters()]
+    optim.step()
+    with torch.no_grad():
+        for p, p0 in zip(stacked.parameters(), before):
+            p.copy_(p0 + lrs.reshape((-1,) + (1,) * (p.dim() - 1)) * (p - p0))
+
+
 BATCH = 64
 # device = torch.device(f"cuda") if torch.cuda.is_available() else torch.device("cpu")
 device = torch.device("cpu")
@@ -78,21 +155,41 @@ covpairs = (("Small Uncorrelated Rotations", "sur", cov1),
             )
 
 if __name__ == "__main__":
+    import argparse
     import tqdm
 
-    for title, acro, cov in covpairs:
-        net = RotPredict(out_type="skewvec").to(device)
-        net.train()
-        process = SO3Diffusion(net, loss_type="skewvec").to(device)
-        optim = torch.optim.Adam(process.denoise_fn.parameters(), lr=3e-4)
-        dist = Bingham(loc, covariance_matrix=cov)
-        for i in tqdm.trange(100000):
-            truepos = quat_to_rmat(dist.sample((BATCH,)))
-            loss = process(truepos)
-            optim.zero_grad()
-            loss.backward()
-            optim.step()
-            if i % 10 == 0:
-                print(loss.item())
-            if i % 1000 == 0:
-                torch.save(net.state_dict(), f"weights/weights_bing_{acro}_{i}.pt")
+    parser = argparse.ArgumentParser(description="Bingham training args")
+    parser.add_argument(
+        "--covs", type=str, nargs="+", default=[acro for _, acro, _ in covpairs],
+        help="covariances to train models for"
+    )
+    parser.add_argument(
+        "--lrs", type=float, nargs="+", default=[3e-4], help="learning rates, a model is trained for each covariance and lr"
+    )
+    parser.add_argument(
+        "--steps", type=int, default=100000, help="training steps"
+    )
+    args = parser.parse_args()
+    runs = [(acro, cov, lr) for _, acro, cov in covpairs if acro in args.covs for lr in args.lrs]
+    lrs = torch.tensor([lr for _, _, lr in runs], device=device)
+    # Checkpoints of a grid over learning rates are told apart by a suffix
+    names = [acro if len(args.lrs) == 1 else f"{acro}_lr{lr:g}" for acro, _, lr in runs]
+
+    # The models are far too small to use the device on their own, so train them all as one stack
+    net = StackedRotPredict([RotPredict(out_type="skewvec") for _ in runs]).to(device)
+    net.train()
+    process = SO3Diffusion(net, loss_type="skewvec").to(device)
+    optim = torch.optim.Adam(net.parameters(), lr=1.0)
+    dists = [Bingham(loc, covariance_matrix=cov) for _, cov, _ in runs]
+    for i in tqdm.trange(args.steps):
+        # Each model keeps its own data stream
+        truepos = torch.stack([quat_to_rmat(dist.sample((BATCH,))) for dist in dists])
+        losses = stacked_losses(process, net, truepos)
+        optim.zero_grad()
+        losses.sum().backward()
+        stacked_adam_step(optim, net, lrs)
+        if i % 10 == 0:
+            print(" ".join(f"{name}: {loss:.5f}" for name, loss in zip(names, losses.tolist())))
+        if i % 1000 == 0:
+            for k, name in enumerate(names):
+                torch.save(net.model_state_dict(k), f"weights/weights_bing_{name}_{i}.pt")
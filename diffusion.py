@@ -1,3 +1,5 @@
+import math
+
 import numpy as np
 import torch
 import torch.nn as nn
@@ -13,7 +15,7 @@ from denoising_diffusion_pytorch.denoising_diffusion_pytorch \
             cosine_beta_schedule,
             )
 from tqdm import tqdm
-from distributions import IsotropicGaussianSO3, IGSO3xR3
+from distributions import IsotropicGaussianSO3, IGSO3Table, sample_igso3xr3, igso3_table
 
 
 def noise_like(shape, device, repeat=False):
@@ -22,6 +24,190 @@ def noise_like(shape, device, repeat=False):
     return repeat_noise() if repeat else noise()
 
 
+def cosine_alphas_cumprod(times, s=0.008):
+    '''Continuous-time version of cosine_beta_schedule, times in [0, 1]
+    '''
+    alphas_cumprod = torch.cos((times + s) / (1 + s) * math.pi * 0.5) ** 2 / math.cos(s / (1 + s) * math.pi * 0.5) ** 2
+    return alphas_cumprod.clamp(min=1e-5, max=1.)
+
+
+def so3_forward_quats(q, betas, block=100):
+    '''Steps quaternions q (b, 4) along the forward process q(x_t|x_{t-1}), yielding each x_t
+
+    IGSO(3) noise for `block` steps is drawn at once from the shared table,
+    leaving a quaternion power and product per step.
+    '''
+    scales = (1 - betas).sqrt()
+    table = igso3_table(q.device)
+    for start in range(0, len(betas), block):
+        eps = betas[start:start + block].sqrt()[:, None].expand(-1, len(q))
+        angles = table.sample_angles(eps)
+        axes = torch.randn((*angles.shape, 3), device=q.device)
+        noise = aa_to_quat(axes / axes.norm(dim=-1, keepdim=True), angles)
+        for t in range(len(eps)):
+            q = quat_mul(quat_pow(q, scales[start + t].expand(len(q))), noise[t])
+            yield q / q.norm(dim=-1, keepdim=True)
+
+
+class SO3SampleWorkspace(object):
+    '''Preallocated buffers for the reverse process of an SO3Diffusion, for a fixed batch size
+
+    The state is carried as unit quaternions, stored component-major (4, b) so each component
+    is a contiguous row. Every step writes into the same buffers with out= and in-place kernels,
+    and per step coefficients and IGSO(3) inverse CDF rows are computed up front, so apart from
+    the denoiser's own output, a step makes no new allocations.
+    Quaternion products are a gather of the left operand into its 4 x 4 matrix, then a
+    broadcast multiply and sum.
+    '''
+
+    # Hamilton product a * b as sum_j L(a)_ij b_j, with L(a)_ij = sign_ij * a[index_ij]
+    MUL_INDEX = (0, 1, 2, 3, 1, 0, 3, 2, 2, 3, 0, 1, 3, 2, 1, 0)
+    MUL_SIGN = (1, -1, -1, -1, 1, 1, -1, 1, 1, 1, 1, -1, 1, -1, 1, 1)
+    # Rotation matrix entries (row major) as combinations of q_i q_j (index 4i + j), for unit q
+    RMAT_TERMS = (((0, 1), (5, 1), (10, -1), (15, -1)),
+                  ((6, 2), (3, -2)),
+                  ((7, 2), (2, 2)),
+                  ((6, 2), (3, 2)),
+                  ((0, 1), (5, -1), (10, 1), (15, -1)),
+                  ((11, 2), (1, -2)),
+                  ((7, 2), (2, -2)),
+                  ((11, 2), (1, 2)),
+                  ((0, 1), (5, -1), (10, -1), (15, 1)),
+                  )
+
+    def __init__(self, process, batch):
+        device = process.betas.device
+        self.batch = batch
+        self.q, self.q2, self.q3, self.q4, self.sq = [torch.zeros((4, batch), device=device) for _ in range(5)]
+        self.v3 = torch.zeros((3, batch), device=device)
+        self.n, self.h, self.s, self.u, self.f, self.w, self.lo, self.hi, self.angles = \
+            [torch.zeros(batch, device=device) for _ in range(9)]
+        self.idx = torch.zeros(batch, dtype=torch.long, device=device)
+        self.idx1 = torch.zeros(batch, dtype=torch.long, device=device)
+        self.t = torch.zeros(batch, dtype=torch.long, device=device)
+        self.L = torch.zeros((16, batch), device=device)
+        self.prod = torch.zeros((4, 4, batch), device=device)
+        self.qq = torch.zeros((16, batch), device=device)
+        self.r9 = torch.zeros((9, batch), device=device)
+        self.rmat = torch.zeros((batch, 3, 3), device=device)
+        self.mul_index = torch.tensor(self.MUL_INDEX, device=device)
+        self.mul_sign = torch.tensor(self.MUL_SIGN, dtype=torch.float, device=device)[:, None]
+        self.rmat_coef = torch.zeros((9, 16), device=device)
+        for row, terms in enumerate(self.RMAT_TERMS):
+            for col, coef in terms:
+                self.rmat_coef[row, col] = coef
+
+        # Per step scalars, as python floats so no tensors are made reading them
+        self.x_t_scale = process.sqrt_recip_alphas_cumprod.tolist()
+        self.noise_scale = process.sqrt_recipm1_alphas_cumprod.tolist()
+        self.coef1 = process.posterior_mean_coef1.tolist()
+        self.coef2 = process.posterior_mean_coef2.tolist()
+        # Inverse CDF of the IGSO(3) angle at each step's stdev, interpolated from the shared table
+        table = igso3_table(device)
+        stdev = (0.5 * process.posterior_log_variance_clipped).exp().to(table.inv_cdf)
+        eps_idx, eps_weight = table._eps_lookup(stdev)
+        self.angle_rows = torch.lerp(table.inv_cdf[eps_idx], table.inv_cdf[eps_idx + 1], eps_weight[:, None])
+        self.angle_scale = (stdev / table.eps_min).clamp(max=1.0).tolist()
+
+    def _mul(self, a, b, out):
+        # out = a * b, out can't be a or b
+        torch.index_select(a, 0, self.mul_index, out=self.L)
+        self.L.mul_(self.mul_sign)
+        torch.mul(self.L.view(4, 4, -1), b[None], out=self.prod)
+        torch.sum(self.prod, dim=1, out=out)
+
+    def _norm(self, v, out):
+        # Euclidean norm over the components of v (c, b), using sq as scratch
+        sq = self.sq[:len(v)]
+        torch.mul(v, v, out=sq)
+        torch.sum(sq, dim=0, out=out)
+        out.sqrt_()
+
+    def _normalise(self, q):
+        self._norm(q, self.n)
+        q.div_(self.n)
+
+    def _pow(self, q, scalar, out):
+        # out = quat_pow(q, scalar), out may be q
+        # Canonical sign, w >= 0: sign(sign(w) + 0.5) is 1 at w == 0
+        torch.sign(q[0], out=self.h)
+        self.h.add_(0.5).sign_()
+        torch.mul(q, self.h, out=out)
+        self._norm(out[1:], self.n)
+        torch.atan2(self.n, out[0], out=self.h)
+        self.h.mul_(scalar)
+        torch.cos(self.h, out=out[0])
+        # sin(s * half) / sin(half), small angles are off by at most the clamp, times a vector part below it
+        torch.sin(self.h, out=self.s)
+        self.s.div_(self.n.clamp_(min=1e-6))
+        out[1:].mul_(self.s)
+
+    def _from_skewvec_conj(self, vec, scalar, out):
+        # out = quat_conj(skewvec_to_quat(vec * scalar)), vec of shape (3, b), scalar >= 0
+        self._norm(vec, self.n)
+        self.n.mul_(scalar)
+        torch.mul(self.n, 0.5, out=self.h)
+        torch.cos(self.h, out=out[0])
+        torch.sin(self.h, out=self.s)
+        self.s.div_(self.n.clamp_(min=1e-6))
+        torch.mul(vec, self.s, out=out[1:])
+        out[1:].mul_(-scalar)
+
+    def _igso3_noise(self, step, out):
+        # out = aa_to_quat of an IGSO(3) sample at the step's posterior stdev
+        row = self.angle_rows[step]
+        self.u.uniform_(0, len(row) - 1)
+        torch.floor(self.u, out=self.f)
+        self.f.clamp_(max=len(row) - 2)
+        self.idx.copy_(self.f)
+        torch.add(self.idx, 1, out=self.idx1)
+        torch.sub(self.u, self.f, out=self.w)
+        torch.index_select(row, 0, self.idx, out=self.lo)
+        torch.index_select(row, 0, self.idx1, out=self.hi)
+        torch.lerp(self.lo, self.hi, self.w, out=self.angles)
+        self.angles.mul_(self.angle_scale[step] * 0.5)
+        self.v3.normal_()
+        self._norm(self.v3, self.n)
+        self.v3.div_(self.n)
+        torch.cos(self.angles, out=out[0])
+        torch.sin(self.angles, out=self.s)
+        torch.mul(self.v3, self.s, out=out[1:])
+
+    def to_rmat(self):
+        '''Rotation matrices (b, 3, 3) of the current state, written into the rmat buffer
+        '''
+        torch.mul(self.q[:, None], self.q[None], out=self.qq.view(4, 4, -1))
+        torch.mm(self.rmat_coef, self.qq, out=self.r9)
+        self.rmat.view(self.batch, 9).copy_(self.r9.t())
+        return self.rmat
+
+    def reset(self):
+        '''Haar-uniform initial state, from normalised gaussian quaternions
+        '''
+        self.q.normal_()
+        self._normalise(self.q)
+
+    def step(self, process, i):
+        '''One reverse step from timestep i, in place. Same update as SO3Diffusion.p_sample_quat
+        '''
+        self.t.fill_(i)
+        predict = process.predict_noise(self.to_rmat(), self.t)
+        self._pow(self.q, self.x_t_scale[i], self.q2)
+        self._from_skewvec_conj(predict.t(), self.noise_scale[i], self.q3)
+        # x_recon
+        self._mul(self.q2, self.q3, self.q4)
+        self._pow(self.q4, self.coef1[i], self.q2)
+        self._pow(self.q, self.coef2[i], self.q3)
+        # posterior mean
+        self._mul(self.q2, self.q3, self.q4)
+        if i == 0:
+            self.q.copy_(self.q4)
+        else:
+            self._igso3_noise(i, self.q3)
+            self._mul(self.q4, self.q3, self.q)
+        self._normalise(self.q)
+
+
 class ObjCache(object):
     def __init__(self, cls, device=torch.device('cpu')):
         self.cls = cls
@@ -278,9 +464,13 @@ class ProjectedGaussianDiffusion(GaussianDiffusion):
 
 
 class SO3Diffusion(GaussianDiffusion):
-    def __init__(self, denoise_fn, timesteps=1000, loss_type='skewvec', betas=None):
+    def __init__(self, denoise_fn, timesteps=1000, loss_type='skewvec', betas=None, rot_repr='rmat'):
         super().__init__(denoise_fn, image_size=None, timesteps=timesteps, loss_type=loss_type, betas=betas)
         self.register_buffer("identity", torch.eye(3))
+        # Representation of the rotation state carried through the sampling loop, "rmat" or "quat"
+        self.rot_repr = rot_repr
+        # Compositions in the rmat sampling loop drift from orthonormal, corrected only when past tolerance
+        self.orthonormality = OrthonormalityPolicy()
 
     def q_mean_variance(self, x_start, t):
         mean = so3_lerp(self.identity, x_start, extract(self.sqrt_alphas_cumprod, t, x_start.shape))
@@ -318,17 +508,46 @@ class SO3Diffusion(GaussianDiffusion):
         model_mean, _, model_log_variance = self.p_mean_variance(x=x, t=t, clip_denoised=clip_denoised)
 
         if (t == 0.0).all():
-            return model_mean
+            return self.orthonormality(model_mean)
         else:
             # no noise when t == 0
             model_stdev = (0.5 * model_log_variance).exp()
             sample = IsotropicGaussianSO3(model_stdev[0]).sample([b])
-            return model_mean @ sample
+            return self.orthonormality(model_mean @ sample)
 
     @torch.no_grad()
-    def p_sample_loop(self, shape):
+    def p_sample_quat(self, q, t):
+        '''p_sample on unit quaternion states
+
+        Same update as p_sample, with compositions and scaling done on quaternions.
+        A matrix is only built for the denoiser, and the state is renormalised each step.
+        '''
+        predict = self.predict_noise(quat_to_rmat(q), t)
+        x_t_term = quat_pow(q, extract(self.sqrt_recip_alphas_cumprod, t, t.shape))
+        noise_term = skewvec_to_quat(predict * extract(self.sqrt_recipm1_alphas_cumprod, t, t.shape)[..., None])
+        x_recon = quat_mul(x_t_term, quat_conj(noise_term))
+
+        c_1 = quat_pow(x_recon, extract(self.posterior_mean_coef1, t, t.shape))
+        c_2 = quat_pow(q, extract(self.posterior_mean_coef2, t, t.shape))
+        model_mean = quat_mul(c_1, c_2)
+
+        if (t == 0).all():
+            out = model_mean
+        else:
+            model_stdev = (0.5 * extract(self.posterior_log_variance_clipped, t, t.shape)).exp()
+            angles = igso3_table(q.device).sample_angles(model_stdev)
+            axes = torch.randn((*angles.shape, 3), device=q.device)
+            out = quat_mul(model_mean, aa_to_quat(axes / axes.norm(dim=-1, keepdim=True), angles))
+        return out / out.norm(dim=-1, keepdim=True)
+
+    @torch.no_grad()
+    def p_sample_loop(self, shape, workspace=None):
         device = self.betas.device
         b = shape[0]
+        if workspace is not None:
+            return self._p_sample_loop_workspace(b, workspace)
+        if self.rot_repr == "quat":
+            return self._p_sample_loop_quat(b)
         # Initial Haar-Uniform random rotations from QR decomp of normal IID matrix
         x = IsotropicGaussianSO3(eps=torch.ones([], device=device)).sample(shape)
 
@@ -336,6 +555,63 @@ class SO3Diffusion(GaussianDiffusion):
             x = self.p_sample(x, torch.full((b,), i, device=device, dtype=torch.long))
         return x
 
+    def _p_sample_loop_quat(self, b):
+        device = self.betas.device
+        # Haar-uniform initial rotations from normalised gaussian quaternions
+        q = torch.randn((b, 4), device=device)
+        q = q / q.norm(dim=-1, keepdim=True)
+        for i in tqdm(reversed(range(0, self.num_timesteps)), desc='sampling loop time step', total=self.num_timesteps):
+            q = self.p_sample_quat(q, torch.full((b,), i, device=device, dtype=torch.long))
+        return quat_to_rmat(q)
+
+    def _p_sample_loop_workspace(self, b, workspace: SO3SampleWorkspace):
+        if workspace.batch != b:
+            raise RuntimeError(f"Workspace is for batches of {workspace.batch}, not {b}")
+        workspace.reset()
+        for i in tqdm(reversed(range(0, self.num_timesteps)), desc='sampling loop time step', total=self.num_timesteps):
+            workspace.step(self, i)
+        return workspace.to_rmat().clone()
+
+    def predict_noise(self, x, t):
+        return self.denoise_fn(x, t)
+
+    def sample_times(self, sample_steps, device=None):
+        '''Evenly spaced timesteps for a reverse process of `sample_steps` steps.
+
+        Runs from num_timesteps - 1 down to -1, where -1 is the noise-free end of the chain.
+        Halving sample_steps picks every other entry, so distilled schedules nest in their teacher's.
+        '''
+        device = default(device, self.betas.device)
+        times = torch.linspace(self.num_timesteps - 1, -1, sample_steps + 1, dtype=torch.float64)
+        return times.round().long().to(device)
+
+    def ddim_alphas_cumprod(self, t):
+        # t == -1 is the clean end of the chain, where alpha_cumprod == 1
+        alphas_cumprod = self.alphas_cumprod[t.clamp(min=0)]
+        return torch.where(t >= 0, alphas_cumprod, torch.ones_like(alphas_cumprod))
+
+    def ddim_step(self, x, t, t_next):
+        '''Deterministic (DDIM, eta=0) step from t to t_next, where t_next needn't be t - 1.
+
+        The predicted noise is re-applied at the noise level of t_next, mirroring q_sample.
+        '''
+        noise = self.predict_noise(x, t)
+        x_recon = self.predict_start_from_noise(x, t=t, noise=noise)
+        alphas_cumprod_next = self.ddim_alphas_cumprod(t_next)
+        x_blend = so3_scale(x_recon, alphas_cumprod_next.sqrt())
+        noise_next = torch.matrix_exp(vec2skew(noise * (1. - alphas_cumprod_next).sqrt()[..., None]))
+        return self.orthonormality(x_blend @ noise_next)
+
+    @torch.no_grad()
+    def ddim_sample_loop(self, shape, sample_steps):
+        device = self.betas.device
+        b = shape[0]
+        x = IsotropicGaussianSO3(eps=torch.ones([], device=device)).sample(shape)
+        times = self.sample_times(sample_steps, device=device)
+        for i in tqdm(range(sample_steps), desc='sampling loop time step', total=sample_steps):
+            x = self.ddim_step(x, times[i].expand(b), times[i + 1].expand(b))
+        return x
+
     def q_sample(self, x_start, t, noise=None):
         if noise is None:
             eps = extract(self.sqrt_one_minus_alphas_cumprod, t, t.shape)
@@ -345,6 +621,35 @@ class SO3Diffusion(GaussianDiffusion):
         x_blend = so3_scale(x_start, scale)
         return x_blend @ noise
 
+    @torch.no_grad()
+    def q_trajectory(self, x_start, sink=None):
+        '''Forward process paths x_0, x_1, ..., x_T from rotations x_start (b, 3, 3)
+
+        returns rotations (T + 1, b, 3, 3). If `sink` is given, it is called as sink(t, x_t)
+        for each step instead, so whole paths don't need to be kept.
+        '''
+        path = [x_start]
+        if sink is not None:
+            sink(0, x_start)
+        for t, q in enumerate(so3_forward_quats(rmat_to_quat(x_start), self.betas), 1):
+            if sink is None:
+                path.append(q)
+            else:
+                sink(t, quat_to_rmat(q))
+        if sink is None:
+            return torch.cat((x_start[None], quat_to_rmat(torch.stack(path[1:]))))
+
+    @torch.no_grad()
+    def q_marginals(self, x_start, t):
+        '''Independent samples of q(x_t|x_0) for timesteps t (n,) and rotations x_start (b, 3, 3)
+
+        returns rotations (n, b, 3, 3), with all noise drawn in one batch.
+        '''
+        eps = self.sqrt_one_minus_alphas_cumprod[t][:, None].expand(-1, len(x_start))
+        noise = igso3_table(x_start.device).sample(eps)
+        scale = self.sqrt_alphas_cumprod[t][:, None].expand_as(eps)
+        return quat_to_rmat(quat_pow(rmat_to_quat(x_start)[None], scale)) @ noise
+
     def p_losses(self, x_start, t, noise=None):
         eps = extract(self.sqrt_one_minus_alphas_cumprod, t, t.shape)
         noisedist = IsotropicGaussianSO3(eps)
@@ -352,9 +657,14 @@ class SO3Diffusion(GaussianDiffusion):
         x_noisy = self.q_sample(x_start=x_start, t=t, noise=noise)
         x_recon = self.denoise_fn(x_noisy, t)
 
-        descaled_noise = skew2vec(log_rmat(noise)) * (1 / eps)[..., None]
         if self.loss_type == "skewvec":
+            descaled_noise = skew2vec(log_rmat(noise)) * (1 / eps)[..., None]
             loss = F.mse_loss(x_recon, descaled_noise)
+        elif self.loss_type == "score":
+            # Denoising score matching, scaled by -2 * eps so that
+            # the target tends to the descaled noise as eps -> 0 and sampling is unchanged
+            descaled_score = -2 * eps[..., None] * noisedist.score(noise)
+            loss = F.mse_loss(x_recon, descaled_score)
         elif self.loss_type == "prevstep":
             # Calculate mean of previous step's distribution
             posterior_mean, _, _ = self.q_posterior(x_start, x_noisy, t)
@@ -375,8 +685,8 @@ class SO3Diffusion(GaussianDiffusion):
 
 
 class ProjectedSO3Diffusion(SO3Diffusion):
-    def __init__(self, denoise_fn, timesteps=1000, loss_type='skewvec', betas=None):
-        super().__init__(denoise_fn, timesteps=timesteps, loss_type=loss_type, betas=betas)
+    def __init__(self, denoise_fn, timesteps=1000, loss_type='skewvec', betas=None, rot_repr='rmat'):
+        super().__init__(denoise_fn, timesteps=timesteps, loss_type=loss_type, betas=betas, rot_repr=rot_repr)
         self.register_buffer("identity", torch.eye(3))
 
     def p_mean_variance(self, x, t, clip_denoised: bool):
@@ -388,10 +698,14 @@ class ProjectedSO3Diffusion(SO3Diffusion):
         return model_mean, posterior_variance, posterior_log_variance
 
     @torch.no_grad()
-    def p_sample_loop(self, shape, projection):
+    def p_sample_loop(self, shape, projection, workspace=None):
         self.projection = projection
         device = self.betas.device
         b = shape[0]
+        if workspace is not None:
+            return self._p_sample_loop_workspace(b, workspace)
+        if self.rot_repr == "quat":
+            return self._p_sample_loop_quat(b)
         # Initial Haar-Uniform random rotations from QR decomp of normal IID matrix
         x, _ = torch.qr(torch.randn((b, 3, 3)))
 
@@ -399,6 +713,22 @@ class ProjectedSO3Diffusion(SO3Diffusion):
             x = self.p_sample(x, torch.full((b,), i, device=device, dtype=torch.long))
         return x
 
+    def predict_noise(self, x, t):
+        return self.denoise_fn(self.projection(x), t)
+
+    @torch.no_grad()
+    def ddim_sample_loop(self, shape, projection, sample_steps):
+        self.projection = projection
+        device = self.betas.device
+        b = shape[0]
+        # Initial Haar-Uniform random rotations from QR decomp of normal IID matrix
+        x, _ = torch.qr(torch.randn((b, 3, 3)))
+        x = x.to(device)
+        times = self.sample_times(sample_steps, device=device)
+        for i in tqdm(range(sample_steps), desc='sampling loop time step', total=sample_steps):
+            x = self.ddim_step(x, times[i].expand(b), times[i + 1].expand(b))
+        return x
+
     def p_losses(self, x_start, t, noise=None):
         eps = extract(self.sqrt_one_minus_alphas_cumprod, t, t.shape)
         noise = IsotropicGaussianSO3(eps).sample().detach()
@@ -429,6 +759,97 @@ class ProjectedSO3Diffusion(SO3Diffusion):
         return self.p_losses(x, t, *args, **kwargs)
 
 
+class ContinuousSO3Diffusion(nn.Module):
+    '''SO(3) diffusion over continuous time in [0, 1].
+
+    The denoiser is conditioned on times * time_scale, so networks built for the 1000 step
+    discrete processes can be reused. IGSO(3) noise for any eps comes from a precomputed
+    IGSO3Table, so the number of sampling steps can be picked at call time.
+    '''
+
+    def __init__(self, denoise_fn, loss_type='skewvec', num_sample_steps=500, time_scale=1000.0, table=None):
+        super().__init__()
+        # Only the descaled skew vector of the noise is defined for continuous times
+        if loss_type != "skewvec":
+            raise RuntimeError(f"Unexpected loss_type: {loss_type}")
+        self.denoise_fn = denoise_fn
+        self.loss_type = loss_type
+        self.num_sample_steps = num_sample_steps
+        self.time_scale = time_scale
+        self.igso3 = default(table, IGSO3Table)
+        self.register_buffer("identity", torch.eye(3))
+
+    def predict_noise(self, x, times):
+        return self.denoise_fn(x, times * self.time_scale)
+
+    def predict_start_from_noise(self, x_t, times, noise):
+        alphas_cumprod = cosine_alphas_cumprod(times)
+        x_t_term = so3_scale(x_t, alphas_cumprod.rsqrt())
+        noise_term = torch.matrix_exp(vec2skew(noise * (1. / alphas_cumprod - 1.).sqrt()[..., None]))
+        # Rotation = multiply by inverse op (matrices, so transpose)
+        return x_t_term @ noise_term.transpose(-1, -2)
+
+    def q_posterior(self, x_start, x_t, times, times_next):
+        # Same as the discrete coefficients, with alpha taken between times_next and times
+        alphas_cumprod = cosine_alphas_cumprod(times)
+        alphas_cumprod_next = cosine_alphas_cumprod(times_next)
+        alphas = alphas_cumprod / alphas_cumprod_next
+        betas = 1. - alphas
+        coef1 = betas * alphas_cumprod_next.sqrt() / (1. - alphas_cumprod)
+        coef2 = (1. - alphas_cumprod_next) * alphas.sqrt() / (1. - alphas_cumprod)
+        posterior_mean = so3_scale(x_start, coef1) @ so3_scale(x_t, coef2)
+        posterior_variance = betas * (1. - alphas_cumprod_next) / (1. - alphas_cumprod)
+        return posterior_mean, posterior_variance
+
+    def p_mean_variance(self, x, times, times_next):
+        predict = self.predict_noise(x, times)
+        x_recon = self.predict_start_from_noise(x, times=times, noise=predict)
+        return self.q_posterior(x_start=x_recon, x_t=x, times=times, times_next=times_next)
+
+    @torch.no_grad()
+    def p_sample(self, x, times, times_next):
+        model_mean, model_variance = self.p_mean_variance(x, times, times_next)
+        if (times_next == 0.0).all():
+            return model_mean
+        else:
+            sample = self.igso3.sample(model_variance.sqrt())
+            return model_mean @ sample
+
+    @torch.no_grad()
+    def p_sample_loop(self, shape, num_sample_steps=None):
+        num_sample_steps = default(num_sample_steps, self.num_sample_steps)
+        device = self.identity.device
+        b = shape[0]
+        # Haar-uniform initial rotations from normalised gaussian quaternions
+        x = quat_to_rmat(torch.randn((b, 4), device=device))
+        steps = torch.linspace(1., 0., num_sample_steps + 1, device=device)
+        for i in tqdm(range(num_sample_steps), desc='sampling loop time step', total=num_sample_steps):
+            x = self.p_sample(x, steps[i].expand(b), steps[i + 1].expand(b))
+        return x
+
+    def q_sample(self, x_start, times, noise=None):
+        alphas_cumprod = cosine_alphas_cumprod(times)
+        if noise is None:
+            noise = self.igso3.sample((1. - alphas_cumprod).sqrt())
+        x_blend = so3_scale(x_start, alphas_cumprod.sqrt())
+        return x_blend @ noise
+
+    def p_losses(self, x_start, times, noise=None):
+        eps = (1. - cosine_alphas_cumprod(times)).sqrt()
+        noise = default(noise, lambda: self.igso3.sample(eps))
+        x_noisy = self.q_sample(x_start=x_start, times=times, noise=noise)
+        x_recon = self.predict_noise(x_noisy, times)
+
+        descaled_noise = skew2vec(log_rmat(noise)) * (1 / eps)[..., None]
+        return F.mse_loss(x_recon, descaled_noise)
+
+    def forward(self, x, *args, **kwargs):
+        b, *_, device = *x.shape, x.device
+        # Keep clear of t == 0, where eps == 0 and the noise can't be descaled
+        times = torch.rand((b,), device=device).clamp(min=1e-4)
+        return self.p_losses(x, times, *args, **kwargs)
+
+
 class SE3Diffusion(GaussianDiffusion):
     def __init__(self, denoise_fn, timesteps=1000, loss_type='grad_mse', betas=None, shift_scale=75.0):
         super().__init__(denoise_fn, image_size=None, timesteps=timesteps, loss_type=loss_type, betas=betas)
@@ -479,7 +900,7 @@ class SE3Diffusion(GaussianDiffusion):
         else:
             # no noise when t == 0
             model_stdev = (0.5 * model_log_variance).exp()
-            sample = IGSO3xR3(eps=model_stdev[0], mean=model_mean, shift_scale=self.shift_scale).sample()
+            sample, _ = sample_igso3xr3(model_stdev, shift_scale=self.shift_scale, mean=model_mean)
             return sample
 
     @torch.no_grad()
@@ -496,20 +917,58 @@ class SE3Diffusion(GaussianDiffusion):
     def q_sample(self, x_start, t, noise=None):
         if noise is None:
             eps = extract(self.sqrt_one_minus_alphas_cumprod, t, t.shape)
-            noise = IGSO3xR3(eps, shift_scale=self.shift_scale).sample()
+            noise, _ = sample_igso3xr3(eps, shift_scale=self.shift_scale)
 
         scale = extract(self.sqrt_alphas_cumprod, t, t.shape)
         x_blend = se3_scale(x_start, scale)
         return AffineT(x_blend.rot @ noise.rot, x_blend.shift + noise.shift)
 
+    @torch.no_grad()
+    def q_trajectory(self, x_start: AffineT, sink=None):
+        '''Forward process paths x_0, x_1, ..., x_T from transforms x_start (b)
+
+        Shifts follow a linear recurrence, x_t = sqrt(alphas_cumprod_t) (x_0 + sum_s noise_s / sqrt(alphas_cumprod_s)),
+        so they are computed for all steps with one cumsum. Rotations are stepped as in SO3Diffusion.q_trajectory.
+        returns an AffineT of shape (T + 1, b). If `sink` is given, it is called as sink(t, x_t)
+        for each step instead.
+        '''
+        b = len(x_start)
+        sqrt_ac = self.sqrt_alphas_cumprod[:, None, None]
+        noise = torch.randn((self.num_timesteps, b, 3), device=x_start.shift.device)
+        noise = noise * (self.betas.sqrt() * self.shift_scale)[:, None, None]
+        shifts = sqrt_ac * (x_start.shift[None] + (noise / sqrt_ac).cumsum(dim=0))
+        shifts = torch.cat((x_start.shift[None], shifts))
+        if sink is not None:
+            sink(0, x_start)
+        rots = [x_start.rot]
+        for t, q in enumerate(so3_forward_quats(rmat_to_quat(x_start.rot), self.betas), 1):
+            if sink is None:
+                rots.append(q)
+            else:
+                sink(t, AffineT(quat_to_rmat(q), shifts[t]))
+        if sink is None:
+            return AffineT(torch.cat((x_start.rot[None], quat_to_rmat(torch.stack(rots[1:])))), shifts)
+
+    @torch.no_grad()
+    def q_marginals(self, x_start: AffineT, t):
+        '''Independent samples of q(x_t|x_0) for timesteps t (n,) and transforms x_start (b)
+
+        returns an AffineT of shape (n, b), with all noise drawn in one batch.
+        '''
+        eps = self.sqrt_one_minus_alphas_cumprod[t][:, None].expand(-1, len(x_start))
+        noise, _ = sample_igso3xr3(eps, shift_scale=self.shift_scale)
+        scale = self.sqrt_alphas_cumprod[t][:, None].expand_as(eps)
+        rot = quat_to_rmat(quat_pow(rmat_to_quat(x_start.rot)[None], scale)) @ noise.rot
+        return AffineT(rot, x_start.shift[None] * scale[..., None] + noise.shift)
+
     def p_losses(self, x_start, t, noise=None):
         eps = extract(self.sqrt_one_minus_alphas_cumprod, t, t.shape)
-        noise = IGSO3xR3(eps, shift_scale=self.shift_scale).sample()
+        noise, noise_tangent = sample_igso3xr3(eps, shift_scale=self.shift_scale)
         x_noisy = self.q_sample(x_start=x_start, t=t, noise=noise)
         x_recon = self.denoise_fn(x_noisy, t)
 
-        descaled_shift = (noise.shift) * (1 / (eps*self.shift_scale))[..., None]
-        descaled_rot = skew2vec(log_rmat(noise.rot)) * (1 / eps)[..., None]
+        descaled_shift = noise_tangent.shift_g * (1 / (eps*self.shift_scale))[..., None]
+        descaled_rot = noise_tangent.rot_g * (1 / eps)[..., None]
         if self.loss_type == "grad_mse":
             loss = F.mse_loss(x_recon.shift, descaled_shift) + F.mse_loss(x_recon.rot, descaled_rot)
         else:
@@ -551,10 +1010,10 @@ class ProjectedSE3Diffusion(SE3Diffusion):
 
     def p_losses(self, x_start, t, noise=None):
         eps = extract(self.sqrt_one_minus_alphas_cumprod, t, t.shape)
-        noise = IGSO3xR3(eps, shift_scale=self.shift_scale).sample()
+        noise, noise_tangent = sample_igso3xr3(eps, shift_scale=self.shift_scale)
         x_noisy = self.q_sample(x_start=x_start, t=t, noise=noise)
-        descaled_shift = (noise.shift) * (1 / (eps*self.shift_scale))[..., None]
-        descaled_rot = skew2vec(log_rmat(noise.rot)) * (1 / (eps))[..., None]
+        descaled_shift = noise_tangent.shift_g * (1 / (eps*self.shift_scale))[..., None]
+        descaled_rot = noise_tangent.rot_g * (1 / eps)[..., None]
         proj_x_noisy = self.projection(x_noisy)
         x_recon = self.denoise_fn(proj_x_noisy, t)
         loss_shift = F.mse_loss(x_recon.shift_g, descaled_shift)
@@ -1,10 +1,50 @@
-from math import pi
+from math import pi, log10
 
+from torch import nn
 from torch.distributions import Distribution, constraints, Normal, MultivariateNormal
+from torch.distributions.multivariate_normal import _batch_mahalanobis
 
 from util import *
 
 
+def igso3_log_density(angles: torch.Tensor, eps: torch.Tensor, eps_switch=0.7, series_terms=8) -> torch.Tensor:
+    '''Log density of IGSO(3) w.r.t. the normalised Haar measure, for rotations by `angles`.
+
+    Evaluated in log space, so it is safe in float32 for any eps.
+    Below eps_switch, uses a gaussian on R^3 with the Haar correction t / (2 sin(t/2)),
+    with the two nearest wrapped images of the gaussian added as a log1p correction.
+    Above it, uses the character series sum_l (2l+1) exp(-l(l+1) eps^2) sin((l+1/2)t) / sin(t/2),
+    which has converged to float64 precision after 8 terms.
+    '''
+    angles, eps = torch.broadcast_tensors(angles, eps)
+    small = eps < eps_switch
+    # Clamp the unused branch of each regime, so neither produces infs/nans (or nan gradients)
+    var = torch.where(small, eps, torch.full_like(eps, eps_switch)) ** 2
+    gauss = 0.5 * log(pi) - 1.5 * var.log() + var / 4 - angles ** 2 / (4 * var)
+    # log(t / (2 sin(t/2))), which goes as t^2 / 24 near t == 0
+    half_angles = angles.clamp(min=1e-4) / 2
+    haar = torch.where(angles > 1e-4, torch.log(half_angles / torch.sin(half_angles)), angles ** 2 / 24)
+    # Wrapped images at t -/+ 2pi, relative to the central gaussian
+    img_minus = torch.exp(pi * (angles - pi) / var)
+    img_plus = torch.exp(-pi * (angles + pi) / var)
+    # (2pi / t) * (img_minus - img_plus), avoiding cancellation at small t
+    x = 2 * pi * angles / var
+    x_small = x.clamp(min=1e-12, max=1.0)
+    img_diff = torch.where(x < 1.0,
+                           (4 * pi ** 2 / var) * img_plus * torch.expm1(x_small) / x_small,
+                           (2 * pi / angles.clamp(min=1e-12)) * (img_minus - img_plus))
+    log_small = gauss + haar + torch.log1p(img_diff - img_minus - img_plus)
+
+    var_large = torch.where(small, torch.full_like(eps, eps_switch), eps) ** 2
+    l = torch.arange(series_terms + 1, device=angles.device, dtype=angles.dtype)
+    weights = (2 * l + 1) * torch.exp(-l * (l + 1) * var_large[..., None])
+    # sin((l+1/2)t) / sin(t/2) = 1 + 2 sum_{k=1}^{l} cos(kt), which is safe at t == 0
+    cos_kt = torch.cos(angles[..., None] * l[1:])
+    dirichlet = torch.cat((torch.ones_like(cos_kt[..., :1]), 1 + 2 * cos_kt.cumsum(dim=-1)), dim=-1)
+    log_large = torch.log((weights * dirichlet).sum(dim=-1))
+    return torch.where(small, log_small, log_large)
+
+
 class IsotropicGaussianSO3(Distribution):
     arg_constraints = {'eps': constraints.positive}
 
@@ -18,7 +58,7 @@ class IsotropicGaussianSO3(Distribution):
         # and need to account for the change in density
         # Scale by 1-cos(t)/pi for sampling
         with torch.no_grad():
-            pdf_sample_vals = self._eps_ft(pdf_sample_locs) * ((1 - pdf_sample_locs.cos()) / pi)
+            pdf_sample_vals = igso3_log_density(pdf_sample_locs, self.eps).exp() * ((1 - pdf_sample_locs.cos()) / pi)
         # Set to 0.0, otherwise there's a divide by 0 here
         pdf_sample_vals[(pdf_sample_locs == 0).expand_as(pdf_sample_vals)] = 0.0
 
@@ -72,15 +112,140 @@ class IsotropicGaussianSO3(Distribution):
         return vals.float()
 
     def log_prob(self, rotations):
-        _, angles = rmat_to_aa(rotations)
-        probs = self._eps_ft(angles)
-        return probs.log()
+        angles = rmat_angle(self._mean_inv @ rotations)
+        return igso3_log_density(angles, self.eps)
+
+    def score(self, rotations):
+        '''Tangent-space score of the log density at `rotations`, interpolated from cached tables
+        '''
+        return igso3_table(rotations.device).score(self._mean_inv @ rotations, self.eps)
 
     @property
     def mean(self):
         return self._mean
 
 
+class IGSO3Table(nn.Module):
+    '''Precomputed IGSO(3) tables over a log-spaced grid of eps.
+
+    Holds inverse CDFs of the rotation angle for sampling,
+    and the log density and its angular derivative for scores.
+    Drawing angles for arbitrary (per-element) eps is a bilinear lookup in (log eps, quantile),
+    so no CDF integration happens per call.
+    Below eps_min the distribution is effectively a Gaussian on R^3, so angles scale linearly with eps.
+    Above eps_max it is indistinguishable from Haar-uniform, so eps is clamped.
+    '''
+
+    def __init__(self, eps_min=1e-3, eps_max=4.0, eps_count=256, quantile_count=1024, angle_count=1024):
+        super().__init__()
+        self.eps_min = eps_min
+        self.log_eps_min = log10(eps_min)
+        self.log_eps_step = (log10(eps_max) - log10(eps_min)) / (eps_count - 1)
+        eps_grid = torch.logspace(log10(eps_min), log10(eps_max), eps_count, dtype=torch.float64)
+        with torch.no_grad():
+            igso3 = IsotropicGaussianSO3(eps_grid)
+        # CDF rows per eps, starting at angle 0
+        cdf = torch.cat((torch.zeros(eps_count, 1, dtype=torch.float64), igso3.trap.T.double()), dim=-1).contiguous()
+        locs = torch.cat((torch.zeros(1, dtype=torch.float64), igso3.trap_loc[:, 0].double()))
+
+        # Invert each row at evenly spaced quantiles
+        quantiles = torch.linspace(0, 1.0, quantile_count, dtype=torch.float64).expand(eps_count, -1).contiguous()
+        idx = torch.searchsorted(cdf, quantiles).clamp(1, len(locs) - 1)
+        cdf_start = torch.gather(cdf, -1, idx - 1)
+        cdf_end = torch.gather(cdf, -1, idx)
+        weight = torch.clamp((quantiles - cdf_start) / (cdf_end - cdf_start).clamp(min=1e-12), 0, 1)
+        inv_cdf = torch.lerp(locs[idx - 1], locs[idx], weight)
+        self.register_buffer("inv_cdf", inv_cdf.float(), persistent=False)
+
+        # Log density on an even angle grid.
+        # The gaussian part -t^2/(4 eps^2) - 3 log(eps) is taken out so the tables stay smooth
+        # at small eps and can be clamped to the first row below eps_min.
+        self.angle_step = pi / (angle_count - 1)
+        angles = torch.linspace(0, pi, angle_count, dtype=torch.float64).expand(eps_count, -1).contiguous()
+        var = eps_grid[:, None] ** 2
+        with torch.enable_grad():
+            angles.requires_grad_(True)
+            log_density_corr = igso3_log_density(angles, eps_grid[:, None]) + angles ** 2 / (4 * var) + 1.5 * var.log()
+            dlog_density_corr, = torch.autograd.grad(log_density_corr.sum(), angles)
+        log_density_corr = log_density_corr.detach()
+        self.register_buffer("log_density_corr", log_density_corr.float(), persistent=False)
+        self.register_buffer("dlog_density_corr", dlog_density_corr.float(), persistent=False)
+
+    def _eps_lookup(self, eps: torch.Tensor):
+        eps_count = self.inv_cdf.shape[0]
+        eps_pos = ((torch.log10(eps) - self.log_eps_min) / self.log_eps_step).clamp(0, eps_count - 1)
+        eps_idx = eps_pos.floor().long().clamp(max=eps_count - 2)
+        return eps_idx, eps_pos - eps_idx
+
+    @staticmethod
+    def _bilinear(table, row_idx, row_weight, col_pos):
+        # Linear interpolation along both table dimensions, row_idx + 1 and col_pos + 1 must be in range
+        cols = table.shape[-1]
+        col_idx = col_pos.floor().long().clamp(max=cols - 2)
+        col_weight = col_pos - col_idx
+        flat_table = table.flatten()
+        flat_idx = row_idx * cols + col_idx
+        lo = torch.lerp(flat_table[flat_idx], flat_table[flat_idx + 1], col_weight)
+        hi = torch.lerp(flat_table[flat_idx + cols], flat_table[flat_idx + cols + 1], col_weight)
+        return torch.lerp(lo, hi, row_weight)
+
+    def sample_angles(self, eps: torch.Tensor, sample_shape=torch.Size()) -> torch.Tensor:
+        shape = (*sample_shape, *eps.shape)
+        eps = eps.to(self.inv_cdf)
+        eps_idx, eps_weight = self._eps_lookup(eps)
+        q_pos = torch.rand(shape, device=eps.device) * (self.inv_cdf.shape[-1] - 1)
+        angles = self._bilinear(self.inv_cdf, eps_idx.expand(shape), eps_weight.expand(shape), q_pos)
+        return angles * (eps / self.eps_min).clamp(max=1.0)
+
+    def sample(self, eps: torch.Tensor, sample_shape=torch.Size()) -> torch.Tensor:
+        angles = self.sample_angles(eps, sample_shape)
+        axes = torch.randn((*angles.shape, 3), device=angles.device)
+        return rodrigues(axes / axes.norm(dim=-1, keepdim=True), angles)
+
+    def log_density(self, angles: torch.Tensor, eps: torch.Tensor) -> torch.Tensor:
+        '''Log density w.r.t. the normalised Haar measure of a rotation by `angles`
+        '''
+        eps = eps.to(self.inv_cdf)
+        angles, eps = torch.broadcast_tensors(angles, eps)
+        eps_idx, eps_weight = self._eps_lookup(eps)
+        corr = self._bilinear(self.log_density_corr, eps_idx, eps_weight, angles / self.angle_step)
+        return corr - angles ** 2 / (4 * eps ** 2) - 3 * eps.log()
+
+    def dlog_density(self, angles: torch.Tensor, eps: torch.Tensor) -> torch.Tensor:
+        '''Derivative of log_density w.r.t. the rotation angle
+        '''
+        eps = eps.to(self.inv_cdf)
+        angles, eps = torch.broadcast_tensors(angles, eps)
+        eps_idx, eps_weight = self._eps_lookup(eps)
+        corr = self._bilinear(self.dlog_density_corr, eps_idx, eps_weight, angles / self.angle_step)
+        return corr - angles / (2 * eps ** 2)
+
+    def score(self, rotations: torch.Tensor, eps: torch.Tensor) -> torch.Tensor:
+        '''Score of IGSO(3)(eps) around the identity as a tangent (skew) vector
+
+        The density only depends on the angle, so the score points along the rotation axis.
+        '''
+        # skew part of a rotation matrix is sin(angle) * axis, no need for the full log_rmat
+        sin_axis = skew2vec(rotations - rotations.transpose(-1, -2)) / 2
+        angles = rmat_angle(rotations)
+        scale = self.dlog_density(angles, eps) / sin_axis.norm(p=2, dim=-1).clamp(min=1e-6)
+        return scale[..., None] * sin_axis
+
+
+_igso3_tables = dict()
+
+
+def igso3_table(device=torch.device('cpu')) -> IGSO3Table:
+    '''Shared IGSO3Table per device, built on first use
+    '''
+    try:
+        table = _igso3_tables[device]
+    except KeyError:
+        table = IGSO3Table().to(device)
+        _igso3_tables[device] = table
+    return table
+
+
 class IGSO3xR3(Distribution):
     arg_constraints = {'eps': constraints.positive}
 
@@ -110,6 +275,27 @@ class IGSO3xR3(Distribution):
         return self._mean
 
 
+def sample_igso3xr3(eps: torch.Tensor, shift_scale=1.0, mean: AffineT = None) -> Tuple[AffineT, AffineGrad]:
+    '''Draws IGSO(3) x R^3 noise with per-element eps in one pass.
+
+    Lightweight alternative to IGSO3xR3(...).sample() for use inside diffusion steps:
+    angles come from the shared IGSO3Table, so nothing is constructed or integrated per call.
+    Returns the noise transform (composed with `mean` if given)
+    and the tangent vectors of the noise itself, i.e. the skew vector of the rotation and the shift.
+    '''
+    if mean is not None:
+        eps = eps.expand(mean.shift.shape[:-1])
+    angles = igso3_table(eps.device).sample_angles(eps)
+    axes = torch.randn((*eps.shape, 3), device=eps.device)
+    axes = axes / axes.norm(dim=-1, keepdim=True)
+    rot = rodrigues(axes, angles)
+    shift = torch.randn((*eps.shape, 3), device=eps.device) * (eps * shift_scale)[..., None]
+    tangent = AffineGrad(rot_g=axes * angles[..., None], shift_g=shift)
+    if mean is not None:
+        return AffineT(mean.rot @ rot, mean.shift + shift), tangent
+    return AffineT(rot, shift), tangent
+
+
 class Bingham(MultivariateNormal):
     arg_constraints = {'covariance_matrix': constraints.positive_definite,
                        'precision_matrix': constraints.positive_definite,
@@ -126,6 +312,52 @@ class Bingham(MultivariateNormal):
         out = vals / vals.norm(dim=-1, keepdim=True)
         return out
 
+    def log_prob(self, value):
+        '''Log density of the normalised samples (an angular central gaussian) w.r.t. the normalised Haar measure
+
+        `value`: quaternions, shape (..., 4). q and -q have the same density, as the same rotation.
+        '''
+        value = value / value.norm(dim=-1, keepdim=True)
+        M = _batch_mahalanobis(self._unbroadcasted_scale_tril, value)
+        half_log_det = self._unbroadcasted_scale_tril.diagonal(dim1=-2, dim2=-1).log().sum(-1)
+        return -half_log_det - 2 * torch.log(M)
+
+
+def fit_bingham(quats: torch.Tensor, iters=100, tol=1e-8) -> Bingham:
+    '''Maximum likelihood Bingham distribution (as sampled here) for a set of quaternions (n, 4)
+
+    Starts from the quaternion second moment matrix, then runs Tyler's fixed point iteration,
+    each iteration being one O(n) pass. The normalising constant is closed form, so no lookup is needed.
+    The covariance is only defined up to scale, it is returned with unit determinant.
+    '''
+    quats = quats.double()
+    quats = quats / quats.norm(dim=-1, keepdim=True)
+    cov = quats.T @ quats / len(quats)
+    cov = cov / cov.det() ** 0.25
+    for _ in range(iters):
+        mahalanobis = (quats @ torch.inverse(cov) * quats).sum(dim=-1)
+        new_cov = 4 * (quats / mahalanobis[:, None]).T @ quats / len(quats)
+        new_cov = new_cov / new_cov.det() ** 0.25
+        converged = (new_cov - cov).abs().max() < tol
+        cov = new_cov
+        if converged:
+            break
+    cov = 0.5 * (cov + cov.T)
+    return Bingham(torch.zeros(4, dtype=cov.dtype, device=cov.device), covariance_matrix=cov)
+
+
+def bingham_fit_report(rotations: torch.Tensor, reference: Bingham):
+    '''Fits a Bingham distribution to rotation matrices and compares it to a reference
+
+    returns the fitted distribution, and the mean log likelihood of the rotations
+    under the fitted and reference distributions. Their difference is a likelihood ratio
+    statistic, close to 0 when the rotations follow the reference.
+    '''
+    quats = rmat_to_quat(rotations).double()
+    fitted = fit_bingham(quats)
+    reference = Bingham(reference.loc.double(), covariance_matrix=reference.covariance_matrix.double())
+    return fitted, fitted.log_prob(quats).mean().item(), reference.log_prob(quats).mean().item()
+
 
 if __name__ == "__main__":
     import matplotlib.pyplot as plt
@@ -176,8 +408,13 @@ if __name__ == "__main__":
     with torch.no_grad():
         same_test = Ker_2samp_log_prob(rb1samp_1, rb1samp_2, rmat_gaussian_kernel, chunksize=4000)
         diff_test = Ker_2samp_log_prob(rb2samp_1, rb1samp_1, rmat_gaussian_kernel, chunksize=4000)
+        # Permutation tests on subsets, as they hold the pooled kernel matrix
+        same_perm = MMDPermutationTest(rb1samp_1[:2000], rb1samp_2[:2000], rmat_gaussian_kernel, chunksize=1000)
+        diff_perm = MMDPermutationTest(rb2samp_1[:2000], rb1samp_1[:2000], rmat_gaussian_kernel, chunksize=1000)
     print("MMD same test:", (same_test))
     print("MMD diff test:", (diff_test))
+    print("Unbiased MMD same, p-value:", same_perm.statistic.item(), same_perm.p_value())
+    print("Unbiased MMD diff, p-value:", diff_perm.statistic.item(), diff_perm.p_value())
 
     axis = torch.randn((3,))
     axis = (axis / axis.norm(dim=-1, p=2, keepdim=True)).repeat(100, 1)
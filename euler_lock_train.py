@@ -63,10 +63,12 @@ if __name__ == "__main__":
 
     R_1 = euler_to_rmat(torch.tensor(0.0), torch.tensor(pi / 3), torch.tensor(0.0))[None].to(device)
     R_2 = euler_to_rmat(torch.tensor(0.0), torch.tensor(2 * pi / 3), torch.tensor(0.0))[None].to(device)
+    # Endpoints are fixed, so the relative rotation is only found once
+    path = GeodesicPath(R_1, R_2)
     sumloss = 0
     for i in range(100000):
         weight = torch.rand(BATCH, 1).to(device)
-        rmats = so3_lerp(R_1, R_2, weight)
+        rmats = path(weight)
         truepos = torch.stack(rmat_to_euler(rmats), dim=-1)
         loss = process(truepos)
         optim.zero_grad()
@@ -0,0 +1,59 @@
+import time
+from math import pi
+
+import torch
+
+from distributions import IsotropicGaussianSO3, igso3_log_density
+
+EPSILONS = (1e-3, 3e-3, 1e-2, 3e-2, 0.1, 0.3, 0.7, 1.0, 2.0, 4.0)
+ANGLES = 1001
+BENCH_SIZE = 1_000_000
+BENCH_RUNS = 10
+
+
+def reference_log_density(angles: torch.Tensor, eps: float) -> torch.Tensor:
+    '''Character series in float64, with enough terms to converge for this eps
+
+    '''
+    var = eps ** 2
+    terms = int((40 / var) ** 0.5) + 10
+    l = torch.arange(terms, dtype=torch.float64)
+    weights = (2 * l + 1) * torch.exp(-l * (l + 1) * var)
+    chars = torch.sin((l + 0.5) * angles[:, None]) / torch.sin(angles[:, None] / 2)
+    return (weights * chars).sum(dim=-1).log()
+
+
+def bench(fn):
+    fn()
+    start = time.perf_counter()
+    for _ in range(BENCH_RUNS):
+        fn()
+    return (time.perf_counter() - start) / BENCH_RUNS
+
+
+if __name__ == "__main__":
+    # Skip angle 0, where the reference series is 0/0
+    angles = torch.linspace(0, pi, ANGLES, dtype=torch.float64)[1:]
+    print("eps & finite (old) & finite (new) & max log err (old) & max log err (new) \\\\")
+    for eps in EPSILONS:
+        eps_t = torch.tensor(eps, dtype=torch.float64)
+        old = IsotropicGaussianSO3(eps_t)._eps_ft(angles).double().log()
+        new = igso3_log_density(angles.float(), eps_t.float()).double()
+        # The float64 reference itself loses precision once the density drops below ~1e-15 of its peak
+        ref = reference_log_density(angles, eps)
+        valid = ref > ref.max() - 25
+        old_err = (old - ref)[valid & old.isfinite()].abs().max().item()
+        new_err = (new - ref)[valid].abs().max().item()
+        print(f"{eps:.0e} & {old.isfinite().float().mean().item():.0%} & {new.isfinite().float().mean().item():.0%}"
+              f" & {old_err:.2e} & {new_err:.2e} \\\\")
+
+    bench_angles = pi * torch.rand(BENCH_SIZE)
+    t_old = 0.0
+    t_new = 0.0
+    for eps in EPSILONS:
+        eps_t = torch.tensor(eps)
+        old_dist = IsotropicGaussianSO3(eps_t)
+        t_old += bench(lambda: old_dist._eps_ft(bench_angles))
+        t_new += bench(lambda: igso3_log_density(bench_angles, eps_t))
+    print(f"float64 _eps_ft: {t_old * 1e3:.1f} ms, log-space float32: {t_new * 1e3:.1f} ms"
+          f" for {BENCH_SIZE} angles at each eps ({t_old / t_new:.1f}x)")
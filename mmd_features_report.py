@@ -0,0 +1,50 @@
+import time
+
+import torch
+
+from bingham_train import covpairs, loc
+from distributions import Bingham
+from util import *
+
+SIZES = (500, 1000, 2000, 4000)
+NUM_FEATURES = (1024, 4096, 16384)
+SEEDS = 5
+BENCH_SIZE = 8000
+
+
+def bingham_rmats(cov, n):
+    return quat_to_rmat(Bingham(loc=loc, covariance_matrix=cov).sample((n,)))
+
+
+if __name__ == "__main__":
+    # Calibrate the random feature approximation against exact MMD with rmat_gaussian_kernel,
+    # comparing each Bingham distribution to the next one in covpairs
+    pairs = list(zip(covpairs, covpairs[1:] + covpairs[:1]))
+    print("X vs Y & n & exact & " + " & ".join(f"D={d} (rel err +- std)" for d in NUM_FEATURES) + " \\\\")
+    for (_, acro_x, cov_x), (_, acro_y, cov_y) in pairs:
+        for n in SIZES:
+            X = bingham_rmats(cov_x, n)
+            Y = bingham_rmats(cov_y, n)
+            exact = MMD(X, Y, rmat_gaussian_kernel, chunksize=2_000).item()
+            cols = []
+            for d in NUM_FEATURES:
+                approx = torch.tensor([
+                    RandomFeatureMMD(X, SO3RandomFeatures(d, generator=torch.Generator().manual_seed(s))).update(Y).result().item()
+                    for s in range(SEEDS)])
+                rel = (approx - exact) / exact
+                cols.append(f"{rel.mean().item():+.2%} +- {rel.std().item():.2%}")
+            print(f"{acro_x} vs {acro_y} & {n} & {exact:.5f} & " + " & ".join(cols) + " \\\\")
+
+    features = SO3RandomFeatures(NUM_FEATURES[1])
+    print(f"truncation tail {features.tail:.4f}, MMD underestimate bound {4 * features.tail:.4f}")
+
+    X = bingham_rmats(covpairs[0][2], BENCH_SIZE)
+    Y = bingham_rmats(covpairs[1][2], BENCH_SIZE)
+    start = time.perf_counter()
+    MMD(X, Y, rmat_gaussian_kernel, chunksize=2_000)
+    t_exact = time.perf_counter() - start
+    start = time.perf_counter()
+    RandomFeatureMMD(X, features).update(Y).result()
+    t_approx = time.perf_counter() - start
+    print(f"exact: {t_exact:.2f}s, random features (D={features.num_features}): {t_approx:.2f}s"
+          f" for {BENCH_SIZE} samples each ({t_exact / t_approx:.1f}x)")
@@ -0,0 +1,40 @@
+import time
+
+import torch
+import torch.nn as nn
+
+from diffusion import SO3Diffusion
+from util import *
+
+BATCH = 4096
+POLICIES = (
+    ("never", dict(tol=float("inf"))),
+    ("tol 1e-6", dict(tol=1e-6)),
+    ("tol 1e-5", dict(tol=1e-5)),
+    ("every 50", dict(tol=float("inf"), every=50)),
+    ("always (svd)", dict(tol=0.0, svd_tol=0.0)),
+)
+
+
+class ZeroDenoiser(nn.Module):
+    '''Predicts no noise, so chains are just compositions of posterior means and IGSO(3) noise
+    '''
+
+    def forward(self, x, t):
+        return torch.zeros(x.shape[:-2] + (3,), device=x.device)
+
+
+if __name__ == "__main__":
+    device = torch.device(f"cuda") if torch.cuda.is_available() else torch.device("cpu")
+    process = SO3Diffusion(ZeroDenoiser(), loss_type="skewvec").to(device)
+    print("policy & corrections & svd corrections & mean drift & max drift & final max drift & time (s) \\\\")
+    for name, kwargs in POLICIES:
+        process.orthonormality = OrthonormalityPolicy(record=True, **kwargs)
+        torch.manual_seed(0)
+        start = time.perf_counter()
+        x = process.p_sample_loop((BATCH,))
+        elapsed = time.perf_counter() - start
+        stats = process.orthonormality.stats()
+        final = orthonormality_drift(x).max().item()
+        print(f"{name} & {stats['corrections']} & {stats['svd_corrections']} & {stats['mean_drift']:.2e}"
+              f" & {stats['max_drift']:.2e} & {final:.2e} & {elapsed:.1f} \\\\")
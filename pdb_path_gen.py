@@ -3,11 +3,9 @@ import pickle
 import shutil
 from pathlib import Path
 
-
-import Bio.PDB as PDB
 import torch
 
-from prot_util import AffineT
+from prot_util import AffineT, pdb_atom_records, transform_coords, write_pdb_trajectory
 
 IN_PATH = "data/BPTI_dock"
 OUT_PATH = "prot_paths"
@@ -25,20 +23,15 @@ prot_count = len(protpaths)
 cpu_paths = pickle.load(open('se3_paths.pkl', 'rb'))
 
 out_dir = Path(OUT_PATH)
-io=PDB.PDBIO()
 
 
 for i, (receptor, ligand) in enumerate(protpaths):
     out_rec = out_dir/receptor.parts[-1]
 
-    lig_struct = PDB.PDBParser().get_structure("null", ligand)
-    for step, tfs in enumerate(cpu_paths):
-        tf = tfs[i]
-        new_struct= lig_struct.copy()
-        rot = tf.rot.cpu().numpy()
-        shift = tf.shift.cpu().numpy() * 40
-        new_struct.transform(rot, shift)
-        lig_file = f'{ligand.stem}_{step:04}.pdb'
-        io.set_structure(new_struct)
-        io.save(str(out_dir/lig_file))
+    records, coords = pdb_atom_records(ligand)
+    # Every step's transform applied at once, written as one multi-model file
+    rots = torch.stack([tfs[i].rot.cpu() for tfs in cpu_paths]).to(coords)
+    shifts = torch.stack([tfs[i].shift.cpu() for tfs in cpu_paths]).to(coords) * 40
+    traj = transform_coords(coords, rots, shifts)
+    write_pdb_trajectory(out_dir/f'{ligand.stem}_traj.pdb', records, traj)
     shutil.copy2(receptor, out_rec)
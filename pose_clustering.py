@@ -0,0 +1,102 @@
+from collections import namedtuple
+
+import torch
+
+from util import *
+
+PoseClusters = namedtuple("PoseClusters", ["representatives", "sizes", "labels"])
+
+
+def pose_dist(a: AffineT, b: AffineT, shift_scale=1.0) -> torch.Tensor:
+    '''Distance between (batched) poses, combining the rotation angle and the translation in units of shift_scale
+    '''
+    ang = rmat_geodesic(a.rot, b.rot)
+    shift = (a.shift - b.shift).norm(dim=-1) / shift_scale
+    return torch.sqrt(ang ** 2 + shift ** 2)
+
+
+class PoseIndex(object):
+    '''Spatial hash of poses, for finding all poses within `radius` of a query
+
+    Rotations are bucketed by voxels of side radius / 2 on their unit quaternions, with the
+    real part non-negative, and translations by voxels of side radius * shift_scale.
+    Rotations an angle t apart have quaternions 2 sin(t / 4) <= t / 2 apart, for one of the
+    signs of either, so any pose within radius of a query lies in the 3^7 neighbouring buckets
+    of the query's quaternion or of its negation. Poses are sorted by bucket, so each bucket
+    is a contiguous range found by binary search.
+    '''
+
+    def __init__(self, poses: AffineT, radius, shift_scale=1.0):
+        self.poses = poses
+        self.radius = radius
+        self.shift_scale = shift_scale
+        voxels = self._voxels(rmat_to_quat(poses.rot), poses.shift)
+        self.vox_min = voxels.min(dim=0).values
+        self.vox_extent = voxels.max(dim=0).values - self.vox_min + 1
+        keys = self._keys(voxels)
+        self.sorted_keys, self.order = keys.sort()
+
+    def _voxels(self, quat: torch.Tensor, shift: torch.Tensor) -> torch.Tensor:
+        # Slightly wider than radius / 2, so rounding in the quaternions can't push a neighbour two cells away
+        quat_vox = (quat / (0.5 * self.radius * (1 + 1e-4))).floor().long()
+        shift_vox = (shift / (self.radius * self.shift_scale)).floor().long()
+        return torch.cat((quat_vox, shift_vox), dim=-1)
+
+    def _keys(self, voxels: torch.Tensor) -> torch.Tensor:
+        v = voxels - self.vox_min
+        key = torch.zeros_like(v[..., 0])
+        for i, extent in enumerate(self.vox_extent.tolist()):
+            key = key * extent + v[..., i]
+        # Voxels outside the indexed range can't hold any poses
+        valid = ((v >= 0) & (v < self.vox_extent)).all(dim=-1)
+        return torch.where(valid, key, torch.full_like(key, -1))
+
+    def candidates(self, pose: AffineT) -> torch.Tensor:
+        '''Indices of poses in the buckets around a single pose (rot (3, 3), shift (3,))
+        '''
+        quat = rmat_to_quat(pose.rot)
+        voxel = self._voxels(torch.stack((quat, -quat)), pose.shift.expand(2, 3))
+        offsets = torch.tensor([-1, 0, 1], device=voxel.device)
+        offsets = torch.cartesian_prod(*(offsets,) * 7)
+        keys = self._keys(voxel[:, None] + offsets[None]).flatten().unique()
+        keys = keys[keys >= 0]
+        starts = torch.searchsorted(self.sorted_keys, keys)
+        ends = torch.searchsorted(self.sorted_keys, keys, right=True)
+        ranges = [torch.arange(s, e, device=keys.device) for s, e in zip(starts.tolist(), ends.tolist()) if e > s]
+        if not ranges:
+            return torch.zeros(0, dtype=torch.long, device=keys.device)
+        return self.order[torch.cat(ranges)]
+
+    def query(self, pose: AffineT) -> torch.Tensor:
+        '''Indices of all poses within radius of a single pose
+        '''
+        idx = self.candidates(pose)
+        dist = pose_dist(self.poses[idx], AffineT(pose.rot[None], pose.shift[None]), self.shift_scale)
+        return idx[dist <= self.radius]
+
+
+def cluster_poses(poses: AffineT, radius=0.1, shift_scale=1.0, priority=None) -> PoseClusters:
+    '''Greedy leader clustering of poses, using the pose_dist metric
+
+    Unassigned poses are taken as cluster representatives in order of `priority`
+    (highest first, input order if None) and claim every unassigned pose within radius.
+    Neighbour search uses PoseIndex, so the cost is proportional to the number of clusters
+    times the poses in their neighbourhoods rather than O(n^2).
+    returns representatives as an AffineT, cluster sizes, and the cluster label of each pose.
+    '''
+    n = len(poses)
+    device = poses.rot.device
+    index = PoseIndex(poses, radius, shift_scale)
+    queue = range(n) if priority is None else priority.argsort(descending=True).tolist()
+    # Labels are kept on the cpu, as they're checked per pose
+    labels = torch.full((n,), -1, dtype=torch.long)
+    leaders = []
+    for leader in queue:
+        if labels[leader] >= 0:
+            continue
+        members = index.query(poses[leader]).cpu()
+        labels[members[labels[members] < 0]] = len(leaders)
+        leaders.append(leader)
+    sizes = torch.bincount(labels, minlength=len(leaders))
+    leaders = torch.tensor(leaders, dtype=torch.long, device=device)
+    return PoseClusters(poses[leaders], sizes.to(device), labels.to(device))
@@ -1,51 +1,80 @@
+import glob
+import os
 import pickle
 
 import matplotlib.pyplot as plt
 import torch
 
 import util
+from pose_clustering import cluster_poses
+from quantile_sketch import QuantileSketch, load_sketches, percentile_row
+from results_store import ResultsReader
 
-se3_samples = pickle.load(open("prot_samples_se3.pkl", "rb"))
-eul_samples = pickle.load(open("prot_samples_eul.pkl", "rb"))
+CLUSTER_RADIUS = 0.2
+PLOT_POINTS = 1000
+# Clustering needs every pose in memory, unlike the sketch based plots and tables
+CLUSTER = True
 
-se3_rots = torch.cat([s.rot for samp in se3_samples for s in samp], dim=0)
-se3_shift = torch.cat([s.shift for samp in se3_samples for s in samp], dim=0)
 
-eul_rots = torch.cat([s.rot for samp in eul_samples for s in samp], dim=0)
-eul_shift = torch.cat([s.shift for samp in eul_samples for s in samp], dim=0)
+def store_paths(diff_type):
+    return sorted(p for p in glob.glob(f"prot_samples_{diff_type}*") if os.path.isdir(p))
 
-trueshift = torch.zeros((1, 3))
-truerot = torch.eye(3)[None]
 
-se3_dists = se3_shift.norm(dim=1)
-eul_dists = eul_shift.norm(dim=1)
+def load_poses(diff_type):
+    '''All sampled poses as flat (rots, shifts), from the results store shards or an older pickle
+    '''
+    paths = store_paths(diff_type)
+    if paths:
+        poses = ResultsReader(*paths).all_poses()
+        return poses.rot.flatten(0, 1), poses.shift.flatten(0, 1)
+    samples = pickle.load(open(f"prot_samples_{diff_type}.pkl", "rb"))
+    rots = torch.cat([s.rot for samp in samples for s in samp], dim=0)
+    shifts = torch.cat([s.shift for samp in samples for s in samp], dim=0)
+    return rots, shifts
 
-_, se3_angles = util.rmat_to_aa(se3_rots)
-_, eul_angles = util.rmat_to_aa(eul_rots)
-print('aaaa')
 
-se3_angle_sort, _ = torch.sort(se3_angles.squeeze())
-eul_angle_sort, _ = torch.sort(eul_angles.squeeze())
-plt.plot(eul_angle_sort.numpy(), label="euler")
-plt.plot(se3_angle_sort.numpy(), label="se3")
-plt.legend()
-plt.show()
+def sketches(diff_type):
+    '''Sketches saved by prot_test, or built by streaming through the samples of older runs
+    '''
+    try:
+        return load_sketches(f"prot_sketch_{diff_type}.pt")
+    except FileNotFoundError:
+        pass
+    out = {"angle": QuantileSketch(), "dist": QuantileSketch()}
+    paths = store_paths(diff_type)
+    if paths:
+        chunks = ((poses.rot, poses.shift) for poses, _ in ResultsReader(*paths).chunks())
+    else:
+        # Pickles can only be loaded whole
+        chunks = [load_poses(diff_type)]
+    for rots, shifts in chunks:
+        out["angle"].update(util.rmat_to_aa(rots)[1])
+        out["dist"].update(shifts.norm(dim=-1))
+    return out
 
-se3_dist_sort, _ = torch.sort(se3_dists.squeeze())
-eul_dist_sort, _ = torch.sort(eul_dists.squeeze())
-plt.plot(eul_dist_sort.numpy(), label="euler")
-plt.plot(se3_dist_sort.numpy(), label="se3")
-plt.legend()
-plt.show()
 
-count = len(se3_angle_sort)
-print(count)
+se3_sketches = sketches("se3")
+eul_sketches = sketches("eul")
+
+# Quantile curves, in place of plotting every sorted sample
+fractions = torch.linspace(0, 1, PLOT_POINTS)
+for key in ("angle", "dist"):
+    plt.plot(fractions.numpy(), eul_sketches[key].quantile(fractions).numpy(), label="euler")
+    plt.plot(fractions.numpy(), se3_sketches[key].quantile(fractions).numpy(), label="se3")
+    plt.legend()
+    plt.show()
+
+print(se3_sketches["angle"].count)
 percentiles = (0.01, 0.05, 0.10, 0.50, 0.90, 0.95, 0.99)
-per_idxs = [int(count * p) for p in percentiles]
-print("percentiles", *[f" & {p:.0%}" for p in  percentiles],r"\\")
-print("euler", *[f" & {eul_angle_sort[i].item():.2f}" for i in per_idxs],r"\\")
-print("so3", *[f" & {se3_angle_sort[i].item():.2f}" for i in per_idxs],r"\\")
-print('------')
-print("percentiles", *[f" & {p:.0%}" for p in  percentiles],r"\\")
-print("euler", *[f" & {eul_dist_sort[i].item():.2f}" for i in per_idxs],r"\\")
-print("so3", *[f" & {se3_dist_sort[i].item():.2f}" for i in per_idxs],r"\\")
+for key in ("angle", "dist"):
+    print("percentiles", *[f" & {p:.0%}" for p in  percentiles],r"\\")
+    print(percentile_row("euler", eul_sketches[key], percentiles))
+    print(percentile_row("so3", se3_sketches[key], percentiles))
+    print('------')
+if CLUSTER:
+    # Every true pose is the identity, so pooled poses from all complexes can be clustered together.
+    # One run is loaded at a time.
+    for name, diff_type in (("euler", "eul"), ("se3", "se3")):
+        rots, shifts = load_poses(diff_type)
+        clusters = cluster_poses(util.AffineT(rots, shifts), radius=CLUSTER_RADIUS)
+        print(f"{name}: {len(rots)} poses in {len(clusters.sizes)} clusters, largest {clusters.sizes.max().item()}")
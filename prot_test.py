@@ -1,12 +1,15 @@
+import shutil
+
 from torch.utils.data import DataLoader
 
 from models import ProtNet
 from prot_util import *
 from util import identity, to_device, init_from_dict
 from diffusion import ProjectedSE3Diffusion, ProjectedEulerDiffusion
+from quantile_sketch import QuantileSketch, save_sketches
+from results_store import ResultsWriter, ResultsReader
 from itertools import count
 from tqdm import tqdm, trange
-import pickle
 
 AUGMENT = True
 SAMPLES = 4
@@ -67,14 +70,27 @@ if __name__ == "__main__":
         action='store_true',
         help="Use SE3 diffusion rather than euler angles",
         )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="base random seed, each batch is seeded from it, recorded with the results",
+        )
+    parser.add_argument(
+        "--resume",
+        action='store_true',
+        help="skip items already in the results store, rather than starting a fresh store",
+        )
     args = parser.parse_args()
+    torch.manual_seed(args.seed)
 
     config = vars(args)
 
 
     device = torch.device(f"cuda") if torch.cuda.is_available() else torch.device("cpu")
     dataset = ProtDataset("data/BPTI_dock")
-    dl = DataLoader(dataset, batch_size=args.batch, shuffle=True,
+    # Not shuffled, so stored item ids are dataset indices
+    dl = DataLoader(dataset, batch_size=args.batch, shuffle=False,
                     num_workers=0, pin_memory=True,
                     collate_fn=identity,
                     # persistent_workers=True,
@@ -97,8 +113,31 @@ if __name__ == "__main__":
         true_pos = torch.zeros(args.batch, 6).to(device)
 
 
-    results = []
-    for i, data in enumerate(tqdm(dl, desc='batch')):
+    # Each batch is flushed to disk as it finishes
+    store_path = f'prot_samples_{diff_type}'
+    sketch_path = f'prot_sketch_{diff_type}.pt'
+    if not args.resume:
+        # Reopened stores are appended to, so a rerun would duplicate every row
+        shutil.rmtree(store_path, ignore_errors=True)
+    # Batches are keyed by their first item and seeded by their index, so only the same layout can be resumed
+    results = ResultsWriter(store_path, SAMPLES, seed=args.seed,
+                            config={"batch": args.batch, "seed": args.seed, "augment": AUGMENT})
+    sketches = {"angle": QuantileSketch(), "dist": QuantileSketch()}
+    done = set()
+    if os.path.exists(os.path.join(store_path, "meta.i64")):
+        reader = ResultsReader(store_path)
+        done = set(reader.column("item").tolist())
+        # Rebuilt from the store, as a crash after an append would leave the saved sketches a batch behind
+        for poses, _ in reader.chunks():
+            sketches["angle"].update(rmat_to_aa(poses.rot)[1])
+            sketches["dist"].update(poses.shift.norm(dim=-1))
+    item = 0
+    for batch_idx, data in enumerate(tqdm(dl, desc='batch')):
+        b = len(data)
+        if item in done:
+            item += b
+            continue
+        torch.manual_seed((args.seed << 32) + batch_idx)
         data = to_device(device, *data)
         # Random transform.
         if AUGMENT:
@@ -117,8 +156,8 @@ if __name__ == "__main__":
         for samp in trange(SAMPLES, leave=False, desc="sample number"):
             with torch.no_grad():
                 # Initial Haar-Uniform random rotations from QR decomp of normal IID matrix
-                R, _ = torch.linalg.qr(torch.randn((args.batch, 3, 3)), "reduced")
-                T = torch.randn((args.batch, 3))
+                R, _ = torch.linalg.qr(torch.randn((b, 3, 3)), "reduced")
+                T = torch.randn((b, 3))
                 if not config['se3']:
                     R = torch.stack(rmat_to_euler(R),dim=-1)
                     transform = torch.cat((R,T), dim=-1)
@@ -131,7 +170,7 @@ if __name__ == "__main__":
                               total=process.num_timesteps,
                               leave=False,
                               ):
-                    transform = process.p_sample(transform, torch.full((args.batch,), i, device=device,
+                    transform = process.p_sample(transform, torch.full((b,), i, device=device,
                                                              dtype=torch.long)).detach()
             # TODO make this SE3 compatible
             if not config['se3']:
@@ -143,5 +182,10 @@ if __name__ == "__main__":
             else:
                 aff_t = transform.to('cpu')
             samples.append(aff_t)
-        results.append(samples)
-pickle.dump(results, open(f'prot_samples_{diff_type}.pkl', 'wb'))
\ No newline at end of file
+            sketches["angle"].update(rmat_to_aa(aff_t.rot)[1])
+            sketches["dist"].update(aff_t.shift.norm(dim=-1))
+        results.append(torch.stack([s.rot for s in samples], dim=1), torch.stack([s.shift for s in samples], dim=1),
+                       items=torch.arange(item, item + b))
+        item += b
+        save_sketches(sketches, sketch_path)
+    results.close()
\ No newline at end of file
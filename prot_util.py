@@ -81,6 +81,44 @@ def move_prot(transf: AffineT, protein: ProtData) -> ProtData:
     return ProtData(protein.residues, l_pos, l_angs)
 
 
+def pdb_atom_records(pdbfile) -> Tuple[List[str], torch.Tensor]:
+    """ATOM/HETATM records of the first model in a PDB file, and their coordinates (atoms, 3)
+    """
+    records = []
+    with open(pdbfile) as f:
+        for line in f:
+            if line.startswith("ENDMDL"):
+                break
+            if line.startswith(("ATOM", "HETATM")):
+                records.append(line.rstrip("\n").ljust(80))
+    coords = torch.tensor([[float(r[30:38]), float(r[38:46]), float(r[46:54])] for r in records])
+    return records, coords
+
+
+def transform_coords(coords: torch.Tensor, rot: torch.Tensor, shift: torch.Tensor) -> torch.Tensor:
+    """Applies a batch of transforms (steps, 3, 3), (steps, 3) to coordinates (atoms, 3) in one op
+
+    Follows Bio.PDB's Entity.transform, coords @ rot + shift, returns (steps, atoms, 3).
+    """
+    return coords @ rot + shift[:, None]
+
+
+def write_pdb_trajectory(path, records: List[str], traj: torch.Tensor):
+    """Writes coordinates (steps, atoms, 3) for the given atom records as a multi-MODEL PDB
+
+    PyMOL loads each model as a state of one object.
+    """
+    traj = traj.detach().cpu().tolist()
+    lines = []
+    for step, coords in enumerate(traj):
+        lines.append(f"MODEL     {step + 1:4d}")
+        lines.extend(f"{r[:30]}{x:8.3f}{y:8.3f}{z:8.3f}{r[54:]}".rstrip() for r, (x, y, z) in zip(records, coords))
+        lines.append("ENDMDL")
+    lines.append("END")
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
 class ProtDataset(Dataset):
     def __init__(self, path):
         super(ProtDataset, self).__init__()
@@ -15,14 +15,15 @@ def render_path(prot_prefix):
     res_path = str(LOCATION/f'{res_name}.pdb')
     cmd.load(res_path)
     cmd.color("gray70", res_name)
-    for step in range(1001):
-        lig_name = f'{prot_prefix}_ligand_{step:04}'
-        lig_path = str(LOCATION/f'{lig_name}.pdb')
-        cmd.load(lig_path)
-        cmd.color("tv_red", lig_name)
+    # The whole ligand path is one multi-model file, loaded as states of one object
+    lig_name = f'{prot_prefix}_ligand_traj'
+    lig_path = str(LOCATION/f'{lig_name}.pdb')
+    cmd.load(lig_path, lig_name)
+    cmd.color("tv_red", lig_name)
+    for step in range(cmd.count_states(lig_name)):
+        cmd.set("state", step + 1)
         cmd.set_view(view)
         cmd.ray(1600,1200)
         cmd.png(str(RENDER_OUT/f'{prot_prefix}_{step:04}.png'))
-        cmd.delete(lig_name)
 
 cmd.extend("render_path",render_path)
\ No newline at end of file
@@ -0,0 +1,117 @@
+from math import ceil
+
+import torch
+
+
+class QuantileSketch(object):
+    '''Mergeable streaming quantile sketch (KLL, Karnin, Lang & Liberty 2016)
+
+    Values are held in levels of compactors, an item at level h standing for 2^h inputs.
+    When a level outgrows its capacity it is sorted and every other item, from a random offset,
+    is promoted to the next level. Capacities shrink geometrically for lower levels,
+    so memory is O(k) and rank error is O(1/k) of the count with high probability.
+    Sketches from separate shards or processes can be merged, and saved with state_dict.
+    '''
+
+    def __init__(self, k=200, c=2 / 3, generator=None):
+        self.k = k
+        self.c = c
+        self.generator = generator
+        self.levels = [torch.zeros(0, dtype=torch.float64)]
+        self.count = 0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def _capacity(self, h):
+        depth = len(self.levels) - 1 - h
+        return max(2, ceil(self.k * self.c ** depth))
+
+    def _compress(self):
+        h = 0
+        while h < len(self.levels):
+            level = self.levels[h]
+            if len(level) > self._capacity(h):
+                if h + 1 == len(self.levels):
+                    self.levels.append(torch.zeros(0, dtype=torch.float64))
+                level, _ = level.sort()
+                # An odd item out stays behind
+                keep = level[:len(level) % 2]
+                pairs = level[len(level) % 2:]
+                offset = torch.randint(0, 2, (1,), generator=self.generator).item()
+                self.levels[h] = keep
+                self.levels[h + 1] = torch.cat((self.levels[h + 1], pairs[offset::2]))
+                # Capacities depend on the number of levels, so start over from the bottom
+                h = 0
+            else:
+                h += 1
+
+    def update(self, values: torch.Tensor):
+        values = values.detach().flatten().double().cpu()
+        if len(values) == 0:
+            return self
+        self.count += len(values)
+        self.min = min(self.min, values.min().item())
+        self.max = max(self.max, values.max().item())
+        self.levels[0] = torch.cat((self.levels[0], values))
+        self._compress()
+        return self
+
+    def merge(self, other: "QuantileSketch"):
+        for h, level in enumerate(other.levels):
+            if h == len(self.levels):
+                self.levels.append(torch.zeros(0, dtype=torch.float64))
+            self.levels[h] = torch.cat((self.levels[h], level))
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._compress()
+        return self
+
+    def quantile(self, q) -> torch.Tensor:
+        '''Approximate quantiles for q in [0, 1] (float or tensor)
+        '''
+        q = torch.as_tensor(q, dtype=torch.float64)
+        values = torch.cat(self.levels)
+        weights = torch.cat([torch.full((len(l),), 2.0 ** h, dtype=torch.float64) for h, l in enumerate(self.levels)])
+        values, order = values.sort()
+        cum_weights = weights[order].cumsum(0)
+        idx = torch.searchsorted(cum_weights, q * cum_weights[-1]).clamp(max=len(values) - 1)
+        out = values[idx]
+        # The extremes are tracked exactly
+        out = torch.where(q <= 0, torch.full_like(out, self.min), out)
+        return torch.where(q >= 1, torch.full_like(out, self.max), out)
+
+    def state_dict(self):
+        return {"k": self.k, "c": self.c, "levels": self.levels, "count": self.count, "min": self.min, "max": self.max}
+
+    @classmethod
+    def from_state_dict(cls, state):
+        sketch = cls(state["k"], state["c"])
+        sketch.levels = list(state["levels"])
+        sketch.count = state["count"]
+        sketch.min = state["min"]
+        sketch.max = state["max"]
+        return sketch
+
+
+def save_sketches(sketches, path):
+    '''Saves a dict of named sketches
+    '''
+    torch.save({name: sketch.state_dict() for name, sketch in sketches.items()}, path)
+
+
+def load_sketches(*paths):
+    '''Loads and merges dicts of named sketches saved by save_sketches, e.g. one per shard
+    '''
+    merged = dict()
+    for path in paths:
+        for name, state in torch.load(path).items():
+            sketch = QuantileSketch.from_state_dict(state)
+            merged[name] = merged[name].merge(sketch) if name in merged else sketch
+    return merged
+
+
+def percentile_row(name, sketch, percentiles):
+    '''A LaTeX table row of the sketch's quantiles
+    '''
+    return " ".join([name] + [f" & {v:.2f}" for v in sketch.quantile(list(percentiles)).tolist()] + [r"\\"])
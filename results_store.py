@@ -0,0 +1,176 @@
+import json
+import os
+
+import numpy as np
+import torch
+
+from util import AffineT
+
+POSE_DIM = 12
+META_COLUMNS = ("item", "sample_start", "checkpoint", "seed")
+
+
+def pose_to_row(rot: torch.Tensor, shift=None) -> torch.Tensor:
+    '''Packs rotations (..., 3, 3) and shifts (..., 3) into float32 rows (..., 12)
+    '''
+    if shift is None:
+        shift = torch.zeros(rot.shape[:-2] + (3,), device=rot.device)
+    return torch.cat((rot.flatten(-2, -1), shift), dim=-1).float()
+
+
+def row_to_pose(rows) -> AffineT:
+    # Copies, as memory mapped arrays are read only
+    rows = torch.as_tensor(np.array(rows))
+    return AffineT(rot=rows[..., :9].reshape(rows.shape[:-1] + (3, 3)), shift=rows[..., 9:])
+
+
+class ResultsWriter(object):
+    '''Appendable on-disk store of sampled poses, [N, S, 12] float32 rows with per-row metadata
+
+    A store is a directory holding a json header, raw float32 poses and raw int64 metadata
+    (META_COLUMNS). Each `append` is written and flushed to disk before returning,
+    so a crash only loses the batch in progress, and reopening a store appends to it.
+    A `config` dict, e.g. of the run's seed and batch size, is kept in the header and
+    reopening the store with a different one raises, so resumed runs can't be mixed.
+    Stores written by parallel workers can be read together or combined with merge_results.
+    '''
+
+    def __init__(self, path, samples, checkpoint=0, seed=0, config=None):
+        self.path = path
+        self.samples = samples
+        self.checkpoint = checkpoint
+        self.seed = seed
+        os.makedirs(path, exist_ok=True)
+        header_path = os.path.join(path, "header.json")
+        if os.path.exists(header_path):
+            with open(header_path) as f:
+                header = json.load(f)
+            if header["samples"] != samples:
+                raise RuntimeError(f"Store {path} has {header['samples']} samples per row, not {samples}")
+            if header.get("config") != config:
+                raise RuntimeError(f"Store {path} was written with {header.get('config')}, not {config}")
+        else:
+            with open(header_path, "w") as f:
+                json.dump({"samples": samples, "pose_dim": POSE_DIM, "meta_columns": META_COLUMNS,
+                           "config": config}, f)
+        self._poses = open(os.path.join(path, "poses.f32"), "ab")
+        self._meta = open(os.path.join(path, "meta.i64"), "ab")
+        # Drop any partial batch left by a crash, so new rows stay aligned
+        rows = os.path.getsize(self._meta.name) // (8 * len(META_COLUMNS))
+        self._meta.truncate(rows * 8 * len(META_COLUMNS))
+        self._poses.truncate(rows * 4 * samples * POSE_DIM)
+
+    def append(self, rot: torch.Tensor, shift=None, items=None, sample_start=0):
+        '''Writes a batch of rotations (B, S, 3, 3) and optional shifts (B, S, 3)
+
+        `items` are ids of the batch rows (e.g. dataset indices), shape (B,).
+        '''
+        rows = pose_to_row(rot, shift).detach().cpu()
+        if rows.shape[1:] != (self.samples, POSE_DIM):
+            raise RuntimeError(f"Expected rows of shape (B, {self.samples}, {POSE_DIM}), got {tuple(rows.shape)}")
+        b = len(rows)
+        items = torch.arange(b) if items is None else torch.as_tensor(items).cpu()
+        meta = torch.stack((items.long(),
+                            torch.full((b,), sample_start, dtype=torch.long),
+                            torch.full((b,), self.checkpoint, dtype=torch.long),
+                            torch.full((b,), self.seed, dtype=torch.long),
+                            ), dim=-1)
+        self.append_rows(rows, meta)
+
+    def append_rows(self, rows: torch.Tensor, meta: torch.Tensor):
+        '''Writes packed pose rows (B, S, 12) with their metadata (B, len(META_COLUMNS)) as is
+        '''
+        # Poses first, so a crash between the writes leaves meta as the shorter file
+        for f, data in ((self._poses, rows), (self._meta, meta)):
+            f.write(data.numpy().tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close(self):
+        self._poses.close()
+        self._meta.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ResultsReader(object):
+    '''Memory mapped reader over one or more stores written by ResultsWriter
+
+    Nothing is loaded until indexed. Rows are counted from the metadata,
+    so a batch cut short by a crash is ignored.
+    '''
+
+    def __init__(self, *paths):
+        self.poses = []
+        self.meta = []
+        samples = None
+        for path in paths:
+            with open(os.path.join(path, "header.json")) as f:
+                header = json.load(f)
+            if samples is not None and header["samples"] != samples:
+                raise RuntimeError(f"Store {path} has {header['samples']} samples per row, not {samples}")
+            samples = header["samples"]
+            meta_path = os.path.join(path, "meta.i64")
+            rows = os.path.getsize(meta_path) // (8 * len(META_COLUMNS))
+            if rows == 0:
+                continue
+            self.meta.append(np.memmap(meta_path, dtype=np.int64, mode="r", shape=(rows, len(META_COLUMNS))))
+            self.poses.append(np.memmap(os.path.join(path, "poses.f32"), dtype=np.float32, mode="r",
+                                        shape=(rows, samples, POSE_DIM)))
+        self.samples = samples
+
+    def __len__(self):
+        return sum(len(m) for m in self.meta)
+
+    def chunks(self, chunksize=4096):
+        '''Yields (AffineT of shape (n, S), metadata (n, 4)) chunks, reading each only when reached
+        '''
+        for poses, meta in zip(self.poses, self.meta):
+            for start in range(0, len(poses), chunksize):
+                yield row_to_pose(poses[start:start + chunksize]), torch.as_tensor(np.array(meta[start:start + chunksize]))
+
+    def rows(self, index):
+        '''(AffineT of shape (n, S), metadata (n, 4)) for rows at global indices (n,) across the stores
+        '''
+        index = np.asarray(index, dtype=np.int64)
+        offsets = np.cumsum([0] + [len(m) for m in self.meta])
+        store = np.searchsorted(offsets, index, side="right") - 1
+        poses = np.empty((len(index), self.samples, POSE_DIM), dtype=np.float32)
+        meta = np.empty((len(index), len(META_COLUMNS)), dtype=np.int64)
+        for s in np.unique(store):
+            mask = store == s
+            local = index[mask] - offsets[s]
+            poses[mask] = self.poses[s][local]
+            meta[mask] = self.meta[s][local]
+        return row_to_pose(poses), torch.as_tensor(meta)
+
+    def column(self, name) -> torch.Tensor:
+        col = META_COLUMNS.index(name)
+        return torch.cat([torch.as_tensor(np.array(m[:, col])) for m in self.meta])
+
+    def all_poses(self) -> AffineT:
+        '''Every pose in the stores, of shape (N, S), loaded into memory
+        '''
+        return row_to_pose(np.concatenate(self.poses))
+
+
+def merge_results(out_path, *paths, chunksize=4096, sort_by=None):
+    '''Combines stores, e.g. shards from parallel workers, into a new store at out_path
+
+    With `sort_by` set to a metadata column, rows are written in (stable) order of it,
+    so the merged store doesn't depend on how work was split between the shards.
+    '''
+    reader = ResultsReader(*paths)
+    if sort_by is None:
+        chunks = reader.chunks(chunksize)
+    else:
+        order = np.argsort(reader.column(sort_by).numpy(), kind="stable")
+        chunks = (reader.rows(order[start:start + chunksize]) for start in range(0, len(order), chunksize))
+    with ResultsWriter(out_path, reader.samples) as writer:
+        for poses, meta in chunks:
+            # Metadata is copied as is, rather than taken from the writer
+            writer.append_rows(pose_to_row(poses.rot, poses.shift), meta)
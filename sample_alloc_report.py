@@ -0,0 +1,79 @@
+import time
+
+import torch
+import torch.nn as nn
+
+from bingham_train import RotPredict
+from diffusion import SO3Diffusion, SO3SampleWorkspace
+
+BATCHES = (512, 4096, 20_000)
+WARMUP_STEPS = 3
+COUNT_STEPS = 10
+BENCH_STEPS = 50
+
+
+class FixedDenoiser(nn.Module):
+    '''Denoiser returning the same preallocated output each call, so only the sampler's allocations are counted
+    '''
+
+    def __init__(self, batch, device):
+        super().__init__()
+        self.out = torch.zeros((batch, 3), device=device)
+
+    def forward(self, x, t):
+        return self.out.normal_()
+
+
+def count_allocations(fn, device):
+    '''Number of new tensor allocations made by fn()
+
+    On cuda this is exact, from the caching allocator's counters. On cpu it is taken
+    from the profiler, so a temporary freed within the op that made it isn't counted.
+    '''
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        before = torch.cuda.memory_stats(device)["allocation.all.allocated"]
+        fn()
+        torch.cuda.synchronize(device)
+        return torch.cuda.memory_stats(device)["allocation.all.allocated"] - before
+    with torch.autograd.profiler.profile(profile_memory=True) as prof:
+        fn()
+    return sum(1 for e in prof.function_events if e.cpu_memory_usage > 0)
+
+
+def sampler_steps(process, workspace, state, steps):
+    '''Runs the last `steps` reverse steps, with p_sample_quat on state["q"] or in the workspace
+    '''
+    def run():
+        for i in reversed(range(steps)):
+            if workspace is None:
+                q = state["q"]
+                state["q"] = process.p_sample_quat(q, torch.full((len(q),), i, device=q.device, dtype=torch.long))
+            else:
+                workspace.step(process, i)
+    return run
+
+
+if __name__ == "__main__":
+    device = torch.device(f"cuda") if torch.cuda.is_available() else torch.device("cpu")
+    print("batch & denoiser & allocs/step (quat) & allocs/step (workspace) & ms/step (quat) & ms/step (workspace) \\\\")
+    for batch in BATCHES:
+        for name, net in (("fixed", FixedDenoiser(batch, device)), ("RotPredict", RotPredict(out_type="skewvec"))):
+            process = SO3Diffusion(net.to(device), loss_type="skewvec").to(device)
+            workspace = SO3SampleWorkspace(process, batch)
+            workspace.reset()
+            state = {"q": workspace.q.t().contiguous()}
+            cols = []
+            with torch.no_grad():
+                for ws in (None, workspace):
+                    sampler_steps(process, ws, state, WARMUP_STEPS)()
+                    allocs = count_allocations(sampler_steps(process, ws, state, COUNT_STEPS), device) / COUNT_STEPS
+                    start = time.perf_counter()
+                    sampler_steps(process, ws, state, BENCH_STEPS)()
+                    if device.type == "cuda":
+                        torch.cuda.synchronize(device)
+                    cols.append((allocs, 1000 * (time.perf_counter() - start) / BENCH_STEPS))
+            (a_quat, t_quat), (a_ws, t_ws) = cols
+            print(f"{batch} & {name} & {a_quat:.1f} & {a_ws:.1f} & {t_quat:.2f} & {t_ws:.2f} \\\\")
+            if name == "fixed" and a_ws != 0:
+                raise RuntimeError(f"Workspace sampling made {a_ws:.1f} allocations per step at batch {batch}")
@@ -1,5 +1,6 @@
+import pickle
+
 import diffusion as diff
-from distributions import IGSO3xR3
 from util import *
 
 SAMPLES = 14
@@ -9,25 +10,11 @@ STEPS = 1000
 device = torch.device(f"cuda") if torch.cuda.is_available() else torch.device("cpu")
 
 
-def se3_step(x_t: AffineT, beta_t, rot_scale, shift_scale) -> AffineT:
-    mean = se3_scale(x_t, torch.sqrt((1 - beta_t)))
-    eps = beta_t
-    out = IGSO3xR3(eps, mean=mean, shift_scale=shift_scale).sample()
-    return out
-
-
 # Not going to use the denoising function, just getting the betas.
 diff_process = diff.SE3Diffusion(None, timesteps=STEPS).to(device)
-rot_scale = diff_process.rot_scale
-shift_scale = diff_process.shift_scale
 
-path = []
-# Run 100 samples in parallel
-x_t = AffineT(rot=torch.eye(3)[None].expand(SAMPLES,-1,-1), shift=torch.zeros(SAMPLES, 3)).to(device)
-for i in range(STEPS):
-    path.append(x_t)
-    beta_t = diff_process.betas[i]
-    x_t = se3_step(x_t, beta_t, rot_scale, shift_scale)
-path.append(x_t)
+# Run all samples in parallel, with every step's noise drawn in batches
+x_0 = AffineT(rot=torch.eye(3)[None].expand(SAMPLES, -1, -1), shift=torch.zeros(SAMPLES, 3)).to(device)
+path = diff_process.q_trajectory(x_0)
 cpu_path = [x.to('cpu') for x in path]
-print('aaa')
\ No newline at end of file
+pickle.dump(cpu_path, open('se3_paths.pkl', 'wb'))
@@ -0,0 +1,123 @@
+import copy
+
+import torch
+from tqdm import tqdm
+
+from bingham_train import covpairs, RotPredict, loc
+from diffusion import SO3Diffusion
+from distributions import Bingham
+from util import *
+
+BATCH = 64
+START_STEPS = 512
+END_STEPS = 8
+STAGE_ITERS = 5000
+SAMPLES = 20_000
+# Largest acceptable increase in MMD over the teacher for the final student
+MMD_TOL = 0.01
+
+
+def distill_loss(teacher: SO3Diffusion, student: SO3Diffusion, x_start, teacher_times):
+    '''Progressive distillation loss for one student step over two teacher steps
+
+    The student takes a single DDIM step from teacher_times[2k] to teacher_times[2k+2],
+    and is matched to the teacher's two steps through teacher_times[2k+1]
+    using the squared geodesic distance between the resulting rotations.
+    For projected diffusion processes, set `projection` on both processes beforehand.
+    '''
+    b = len(x_start)
+    device = x_start.device
+    k = torch.randint(0, (len(teacher_times) - 1) // 2, (b,), device=device)
+    t = teacher_times[2 * k]
+    t_mid = teacher_times[2 * k + 1]
+    t_next = teacher_times[2 * k + 2]
+    with torch.no_grad():
+        x_t = teacher.q_sample(x_start, t)
+        x_mid = teacher.ddim_step(x_t, t, t_mid)
+        target = teacher.ddim_step(x_mid, t_mid, t_next)
+    pred = student.ddim_step(x_t, t, t_next)
+    return rmat_dist(pred, target).pow(2.0).mean()
+
+
+def distill_stage(teacher: SO3Diffusion, teacher_steps, data_fn, iters=STAGE_ITERS, lr=1e-4):
+    '''Trains a student to sample in teacher_steps // 2 steps
+
+    The student starts from a copy of the teacher.
+    `data_fn` returns a batch of clean rotations for each training step.
+    '''
+    student = copy.deepcopy(teacher)
+    student.denoise_fn.train()
+    teacher.denoise_fn.eval()
+    optim = torch.optim.Adam(student.denoise_fn.parameters(), lr=lr)
+    teacher_times = teacher.sample_times(teacher_steps)
+    for i in tqdm(range(iters), desc=f'distilling {teacher_steps} -> {teacher_steps // 2} steps'):
+        loss = distill_loss(teacher, student, data_fn(), teacher_times)
+        optim.zero_grad()
+        loss.backward()
+        optim.step()
+        if i % 100 == 0:
+            print(loss.item())
+    student.denoise_fn.eval()
+    return student
+
+
+def save_distilled(net, sample_steps, path):
+    torch.save({"state_dict": net.state_dict(), "sample_steps": sample_steps}, path)
+
+
+def load_distilled(net, path, map_location=None):
+    '''Loads a distilled checkpoint into `net`, returns the number of sampling steps it was trained for
+    '''
+    checkpoint = torch.load(path, map_location=map_location)
+    net.load_state_dict(checkpoint["state_dict"])
+    return checkpoint["sample_steps"]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Progressive distillation args")
+    parser.add_argument(
+        "cov", type=str, help="covariance matrix to use", choices=["sur", "scr", "lur", "lcr"]
+        )
+    parser.add_argument(
+        "--step", type=int, default=100_000, help="training step of the teacher checkpoint"
+        )
+    parser.add_argument(
+        "--start_steps", type=int, default=START_STEPS, help="sampling steps of the teacher"
+        )
+    parser.add_argument(
+        "--end_steps", type=int, default=END_STEPS, help="sampling steps of the final student"
+        )
+    parser.add_argument(
+        "--iters", type=int, default=STAGE_ITERS, help="training iterations per stage"
+        )
+    args = parser.parse_args()
+
+    device = torch.device(f"cuda") if torch.cuda.is_available() else torch.device("cpu")
+    acro = args.cov
+    cov, = [c for _, a, c in covpairs if a == acro]
+    dist = Bingham(loc.to(device), covariance_matrix=cov.to(device))
+
+    net = RotPredict(out_type="skewvec").to(device)
+    net.load_state_dict(torch.load(f"weights/weights_bing_{acro}_{args.step}.pt", map_location=device))
+    net.eval()
+    teacher = SO3Diffusion(net, loss_type="skewvec").to(device)
+    process = teacher
+
+    steps = args.start_steps
+    while steps > args.end_steps:
+        process = distill_stage(process, steps, lambda: quat_to_rmat(dist.sample((BATCH,))), iters=args.iters)
+        steps //= 2
+        save_distilled(process.denoise_fn, steps, f"weights/weights_bing_{acro}_distill_{steps}.pt")
+
+    # Compare final student against the full-length teacher
+    with torch.no_grad():
+        bing_samples = quat_to_rmat(dist.sample((SAMPLES,)))
+        teacher_samples = teacher.p_sample_loop((SAMPLES,))
+        student_samples = process.ddim_sample_loop((SAMPLES,), steps)
+        teacher_mmd = MMD(bing_samples, teacher_samples, rmat_gaussian_kernel, chunksize=4_000).item()
+        student_mmd = MMD(bing_samples, student_samples, rmat_gaussian_kernel, chunksize=4_000).item()
+    print(f"teacher ({teacher.num_timesteps} steps) MMD: {teacher_mmd:.5f}")
+    print(f"student ({steps} steps) MMD: {student_mmd:.5f}")
+    print("within tolerance" if student_mmd - teacher_mmd <= MMD_TOL else "outside tolerance")
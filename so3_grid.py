@@ -0,0 +1,181 @@
+from math import pi, sqrt
+
+import torch
+
+from util import *
+
+
+def sphere_to_square(d: torch.Tensor) -> torch.Tensor:
+    '''Equal area map from unit vectors (..., 3) to the square [-1, 1]^2 (octahedral, Clarberg 2008)
+
+    The upper hemisphere maps to the diamond |u| + |v| <= 1, the lower one to the corners.
+    '''
+    x, y, z = torch.unbind(d, -1)
+    r = torch.sqrt((1 - z.abs()).clamp(min=0.0))
+    phi = torch.atan2(y.abs(), x.abs())
+    v = r * phi * (2 / pi)
+    u = r - v
+    lower = z < 0
+    u, v = torch.where(lower, 1 - v, u), torch.where(lower, 1 - u, v)
+    # Sign on zero should follow the positive side, so points on the axes land in a single cell
+    sign_x = torch.where(x < 0, -torch.ones_like(x), torch.ones_like(x))
+    sign_y = torch.where(y < 0, -torch.ones_like(y), torch.ones_like(y))
+    return torch.stack((sign_x * u, sign_y * v), dim=-1)
+
+
+def square_to_sphere(uv: torch.Tensor) -> torch.Tensor:
+    '''Inverse of sphere_to_square
+    '''
+    u, v = torch.unbind(uv, -1)
+    lower = u.abs() + v.abs() > 1
+    a = torch.where(lower, 1 - v.abs(), u.abs())
+    b = torch.where(lower, 1 - u.abs(), v.abs())
+    r = a + b
+    phi = torch.where(r > 0, b / r.clamp(min=1e-12), torch.zeros_like(r)) * (pi / 2)
+    z = 1 - r ** 2
+    z = torch.where(lower, -z, z)
+    s = r * torch.sqrt((2 - r ** 2).clamp(min=0.0))
+    return torch.stack((torch.sign(u) * s * torch.cos(phi), torch.sign(v) * s * torch.sin(phi), z), dim=-1)
+
+
+def _z_section(d: torch.Tensor):
+    '''Images of x and y under the smallest rotation taking z to d, singular only at d = -z
+    '''
+    dx, dy, dz = torch.unbind(d, -1)
+    k = 1 / (1 + dz).clamp(min=1e-6)
+    ex = torch.stack((1 - dx * dx * k, -dx * dy * k, -dx), dim=-1)
+    ey = torch.stack((-dx * dy * k, 1 - dy * dy * k, -dy), dim=-1)
+    return ex, ey
+
+
+class SO3Grid(object):
+    '''Equivolumetric grid on SO(3) from the Hopf fibration
+
+    A rotation R is split into the direction d = R z on the sphere, and the twist psi
+    about it relative to the smallest rotation taking z to d. Haar measure is uniform in both,
+    so with an equal area grid of n_side x n_side cells on the sphere and n_psi even bins
+    of psi, all cells have exactly the same volume.
+    Point to cell lookup is closed form, so histograms over any number of rotations are linear time.
+    Cells are well shaped except around d = -z, where the twist is singular.
+    '''
+
+    def __init__(self, n_side=16, n_psi=None, device=torch.device('cpu')):
+        self.n_side = n_side
+        # Roughly cubic cells: psi bin width matches the sphere cell side
+        self.n_psi = n_psi if n_psi is not None else max(1, round(sqrt(pi) * n_side))
+        self.num_cells = n_side * n_side * self.n_psi
+        self.device = device
+        self._centers = None
+        self._tables = dict()
+
+    def _coords(self, rotations: torch.Tensor) -> torch.Tensor:
+        d = rotations[..., :, 2]
+        ex, ey = _z_section(d)
+        rx = rotations[..., :, 0]
+        psi = torch.atan2((rx * ey).sum(-1), (rx * ex).sum(-1))
+        uv = sphere_to_square(d)
+        return torch.cat((uv, psi[..., None]), dim=-1)
+
+    def _bins(self, rotations: torch.Tensor):
+        coords = self._coords(rotations)
+        ij = ((coords[..., :2] + 1) * (self.n_side / 2)).floor().long().clamp(0, self.n_side - 1)
+        k = ((coords[..., 2] + pi) * (self.n_psi / (2 * pi))).floor().long() % self.n_psi
+        return ij[..., 0], ij[..., 1], k
+
+    def _flat(self, i, j, k):
+        return (i * self.n_side + j) * self.n_psi + k
+
+    def cell_index(self, rotations: torch.Tensor) -> torch.Tensor:
+        '''Cell containing each rotation (..., 3, 3), returns indices of shape (...)
+        '''
+        return self._flat(*self._bins(rotations))
+
+    def cell_centers(self) -> torch.Tensor:
+        '''Rotation at the center of each cell, shape (num_cells, 3, 3), cached
+        '''
+        if self._centers is None:
+            side = (torch.arange(self.n_side, device=self.device) + 0.5) * (2 / self.n_side) - 1
+            psi = (torch.arange(self.n_psi, device=self.device) + 0.5) * (2 * pi / self.n_psi) - pi
+            u, v, psi = [c.flatten() for c in torch.meshgrid(side, side, psi)]
+            d = square_to_sphere(torch.stack((u, v), dim=-1))
+            ex, ey = _z_section(d)
+            rx = torch.cos(psi)[:, None] * ex + torch.sin(psi)[:, None] * ey
+            ry = torch.cross(d, rx, dim=-1)
+            self._centers = torch.stack((rx, ry, d), dim=-1)
+        return self._centers
+
+    def histogram(self, rotations: torch.Tensor, weights=None, chunksize=1_000_000) -> torch.Tensor:
+        '''Counts (or summed weights) of rotations (n, 3, 3) in each cell
+        '''
+        counts = torch.zeros(self.num_cells, device=rotations.device)
+        for start in range(0, len(rotations), chunksize):
+            idx = self.cell_index(rotations[start:start + chunksize])
+            w = None if weights is None else weights[start:start + chunksize]
+            counts += torch.bincount(idx, weights=w, minlength=self.num_cells).to(counts)
+        return counts
+
+    def density(self, rotations: torch.Tensor, weights=None) -> torch.Tensor:
+        '''Histogram density estimate per cell, w.r.t. the normalised Haar measure
+        '''
+        counts = self.histogram(rotations, weights)
+        return counts * (self.num_cells / counts.sum())
+
+    def coverage(self, rotations: torch.Tensor, min_count=1) -> float:
+        '''Fraction of cells holding at least `min_count` of the rotations
+        '''
+        return (self.histogram(rotations) >= min_count).float().mean().item()
+
+    def mode_mass(self, rotations: torch.Tensor, modes: torch.Tensor, radius=0.2, chunksize=100_000) -> torch.Tensor:
+        '''Fraction of rotations (n, 3, 3) within `radius` of each of the modes (m, 3, 3)
+
+        Counted per rotation, as cells are too coarse to select by their centers for radii
+        below the cell size. Rotations are only held in chunks, as with histogram.
+        '''
+        counts = torch.zeros(len(modes), device=rotations.device)
+        for start in range(0, len(rotations), chunksize):
+            near = rmat_geodesic_cdist(modes.to(rotations), rotations[start:start + chunksize]) < radius
+            counts += near.sum(dim=-1).to(counts)
+        return counts / len(rotations)
+
+    def neighbours(self, index: torch.Tensor) -> torch.Tensor:
+        '''The cell and its 26 neighbours for each cell index (...), returns shape (..., 27)
+        '''
+        k = index % self.n_psi
+        j = (index // self.n_psi) % self.n_side
+        i = index // (self.n_psi * self.n_side)
+        offsets = torch.tensor([-1, 0, 1], device=index.device)
+        di, dj, dk = [o.flatten() for o in torch.meshgrid(offsets, offsets, offsets)]
+        ni, nj, nk = i[..., None] + di, j[..., None] + dj, (k[..., None] + dk) % self.n_psi
+        # The square's edges are glued to themselves mirrored, (+-1, v) ~ (+-1, -v)
+        flip_i = (ni < 0) | (ni >= self.n_side)
+        flip_j = (nj < 0) | (nj >= self.n_side)
+        ni, nj = ni.clamp(0, self.n_side - 1), nj.clamp(0, self.n_side - 1)
+        ni, nj = torch.where(flip_j, self.n_side - 1 - ni, ni), torch.where(flip_i, self.n_side - 1 - nj, nj)
+        return self._flat(ni, nj, nk)
+
+    def nearest_cell(self, rotations: torch.Tensor) -> torch.Tensor:
+        '''Cell with the nearest center to each rotation (n, 3, 3), among the containing cell and its neighbours
+        '''
+        candidates = self.neighbours(self.cell_index(rotations))
+        centers = self.cell_centers().to(rotations)[candidates]
+        best = rmat_geodesic(centers, rotations[:, None]).argmin(dim=-1)
+        return candidates.gather(-1, best[:, None])[:, 0]
+
+    def density_table(self, name, log_prob_fn) -> torch.Tensor:
+        '''log_prob_fn evaluated at the cell centers, cached under `name`
+        '''
+        if name not in self._tables:
+            self._tables[name] = log_prob_fn(self.cell_centers())
+        return self._tables[name]
+
+
+_so3_grids = dict()
+
+
+def so3_grid(n_side=16, device=torch.device('cpu')) -> SO3Grid:
+    '''Shared SO3Grid per resolution and device, so centers and density tables are only built once
+    '''
+    key = (n_side, str(device))
+    if key not in _so3_grids:
+        _so3_grids[key] = SO3Grid(n_side, device=device)
+    return _so3_grids[key]
@@ -13,7 +13,8 @@ R_2_1 = euler_to_rmat(torch.tensor(0.0), torch.tensor(2 * pi / 3), torch.tensor(
 points = 1000
 weights = torch.linspace(0, 1, points)
 
-distrib = so3_lerp(R_1_1[None], R_2_1[None], weights[:, None])
+path = GeodesicPath(R_1_1[None], R_2_1[None]).precompute(weights)
+distrib = path.lookup(torch.arange(points))[:, 0]
 
 x, y, z = rmat_to_euler(distrib)
 distrib_back = euler_to_rmat(x,y,z)
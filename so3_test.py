@@ -6,6 +6,7 @@ from tqdm import tqdm
 from util import *
 
 from diffusion import SO3Diffusion
+from so3_grid import so3_grid
 
 BATCH = 512
 
@@ -75,12 +76,21 @@ if __name__ == "__main__":
     z90 = torch.tensor([[0.0,-1.0, 0.0],
                         [1.0, 0.0, 0.0],
                         [0.0, 0.0, 1.0]])
-    z90pangle = rmat_dist(res, z90[None,None]) * 0.70710678118
-    z90mangle = rmat_dist(res, z90.T[None, None]) * 0.70710678118
+    z90pangle = rmat_geodesic(res, z90[None,None])
+    z90mangle = rmat_geodesic(res, z90.T[None, None])
     z90close = (z90pangle[0] < z90mangle[0])
     z90stack = torch.stack((z90mangle, z90pangle),dim=0)
     z90best = torch.gather(z90stack, 0, z90close.expand(1, *z90stack.shape[1:]).to(int))[0]
     plt.plot(torch.arange(1000).flip(0), z90best, alpha=0.2, c="#1f77b4")
     plt.show()
     plt.savefig("2.png")
+    # Share of final samples at each target
+    grid = so3_grid(8)
+    modes = torch.stack((z90, z90.T))
+    # Samples exactly at the modes must be counted, half at each
+    at_modes = grid.mode_mass(modes, modes, radius=0.3)
+    if not torch.allclose(at_modes, torch.full_like(at_modes, 0.5)):
+        raise RuntimeError(f"mode_mass of samples at the modes is {at_modes.tolist()}, expected 0.5 each")
+    mass = grid.mode_mass(out, modes, radius=0.3)
+    print(f"mass near z90: {mass[0].item():.2%}, near z-90: {mass[1].item():.2%}")
     print('done')
\ No newline at end of file
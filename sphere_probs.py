@@ -41,7 +41,7 @@ for eps in epsilons:
     for i in range(3):
         axis = axes[i, :, None, None]
         angles = (points * axis).sum(dim=0).acos()
-        probs = dist._eps_ft(angles).abs().log()
+        probs = distributions.igso3_log_density(angles, eps)
         probs[probs.isinf()] = VMIN
         print(probs.max().item(), probs.min().item())
 
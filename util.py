@@ -1,8 +1,8 @@
 import inspect
+import os
 from collections import namedtuple
 from typing import Tuple, Iterable
-from math import sqrt, log, exp
-from itertools import product
+from math import sqrt, log, exp, pi
 
 import torch
 
@@ -107,6 +107,93 @@ def orthogonalise(mat):
     return orth_mat
 
 
+def orthonormality_drift(rmat: torch.Tensor) -> torch.Tensor:
+    '''Frobenius norm of R^T R - I for (batched) matrices (..., 3, 3), 0 for exact rotations
+    '''
+    eye = torch.eye(3, device=rmat.device, dtype=rmat.dtype)
+    return (rmat.transpose(-1, -2) @ rmat - eye).flatten(-2).norm(dim=-1)
+
+
+def newton_schulz_orthonormalise(rmat: torch.Tensor, iters=2) -> torch.Tensor:
+    '''Nearest orthonormal matrices (polar factor) by Newton-Schulz iteration, X <- X (3I - X^T X) / 2
+
+    Each iteration squares the drift, so for matrices that are already nearly orthonormal
+    one or two iterations reach rounding error, at the cost of a few 3x3 matmuls rather than an SVD.
+    Only converges for drift below ~1, see orthogonalise for the general case.
+    '''
+    eye = torch.eye(3, device=rmat.device, dtype=rmat.dtype)
+    for _ in range(iters):
+        rmat = 0.5 * rmat @ (3 * eye - rmat.transpose(-1, -2) @ rmat)
+    return rmat
+
+
+class OrthonormalityPolicy(object):
+    '''Keeps chains of composed rotation matrices orthonormal, correcting only those that drift
+
+    Each call measures the drift ||R^T R - I|| of a batch of rotations. Those above `tol`,
+    or all of them every `every` calls, are replaced by their Newton-Schulz iterates, so the
+    correction is only paid for rotations that need it, at the cost of one device sync per call.
+    Newton-Schulz only converges for drift below ~1, so rotations past `svd_tol`
+    fall back to an SVD (orthogonalise). With `record`, drift statistics are kept for `stats`.
+    '''
+
+    def __init__(self, tol=1e-5, every=None, iters=2, svd_tol=0.5, record=False):
+        self.tol = tol
+        self.every = every
+        self.iters = iters
+        self.svd_tol = svd_tol
+        self.record = record
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.calls = 0
+        self.corrections = 0
+        self.svd_corrections = 0
+        self.drift_sum = 0.0
+        self.drift_count = 0
+        self.max_drift = 0.0
+        self.history = []
+
+    def __call__(self, rmat: torch.Tensor) -> torch.Tensor:
+        self.calls += 1
+        if rmat[..., 0, 0].numel() == 0:
+            return rmat
+        drift = orthonormality_drift(rmat.detach())
+        if self.record:
+            self.drift_sum = self.drift_sum + drift.sum()
+            self.drift_count += drift.numel()
+            self.max_drift = torch.max(drift.max(), torch.as_tensor(self.max_drift).to(drift))
+            self.history.append(drift.max())
+        if self.every is not None and self.calls % self.every == 0:
+            over = torch.ones_like(drift, dtype=torch.bool)
+        else:
+            over = drift > self.tol
+        if not over.any():
+            return rmat
+        idx = over.nonzero(as_tuple=True)
+        fixed = newton_schulz_orthonormalise(rmat[idx], self.iters)
+        if self.svd_tol is not None:
+            far = drift[idx] > self.svd_tol
+            if far.any():
+                fixed[far] = orthogonalise(rmat[idx][far])
+                if self.record:
+                    self.svd_corrections += int(far.sum())
+        if self.record:
+            self.corrections += len(fixed)
+        out = rmat.clone()
+        out[idx] = fixed
+        return out
+
+    def stats(self):
+        '''Drift before correction: mean and max over all rotations seen, and the per call max.
+        Corrections are counted per rotation. All are only kept with `record`.
+        '''
+        mean = float(self.drift_sum / self.drift_count) if self.drift_count else 0.0
+        return {"calls": self.calls, "corrections": int(self.corrections), "svd_corrections": self.svd_corrections,
+                "mean_drift": mean, "max_drift": float(self.max_drift),
+                "history": torch.stack(self.history).tolist() if self.history else []}
+
+
 def rmat_cosine_dist(m1: torch.Tensor, m2: torch.Tensor) -> torch.Tensor:
     ''' Calculate the cosine distance between two (batched) rotation matrices
 
@@ -125,14 +212,43 @@ def rmat_cosine_dist(m1: torch.Tensor, m2: torch.Tensor) -> torch.Tensor:
     return out
 
 
+def rmat_geodesic(m1: torch.Tensor, m2: torch.Tensor) -> torch.Tensor:
+    ''' Calculate the geodesic distance (rotation angle of m1^T m2) between two (batched) rotation matrices
+
+    Broadcasts like rmat_dist, but without log_rmat.
+    '''
+    # ||m1 - m2||_F^2 = 2 * (3 - tr(m1^T m2)) = 8 * sin^2(angle / 2)
+    # unlike acos of the trace, there's no cancellation for small angles
+    chord = (m1 - m2).flatten(-2, -1).norm(p=2, dim=-1)
+    return 2 * torch.asin((chord / (2 * sqrt(2))).clamp(max=1.0))
+
+
+def rmat_geodesic_cdist(m1: torch.Tensor, m2: torch.Tensor) -> torch.Tensor:
+    ''' Pairwise geodesic distances between rotation matrices m1 (N, 3, 3) and m2 (M, 3, 3)
+
+    returns distances of shape (N, M).
+    '''
+    chord = torch.cdist(m1.flatten(-2, -1), m2.flatten(-2, -1), compute_mode='donot_use_mm_for_euclid_dist')
+    return 2 * torch.asin((chord / (2 * sqrt(2))).clamp(max=1.0))
+
+
 def rmat_gaussian_kernel(m1: torch.Tensor, m2: torch.Tensor) -> torch.Tensor:
     ''' Calculate the gaussian kernel between two (batched) rotation matrices
 
     '''
-    dist = rmat_dist(m1,m2)
+    # rmat_dist is the Frobenius norm of the log, which is sqrt(2) * angle
+    dist = sqrt(2) * rmat_geodesic(m1, m2)
 
     return torch.exp(-dist)
 
+
+def rmat_gaussian_kernel_cdist(m1: torch.Tensor, m2: torch.Tensor) -> torch.Tensor:
+    ''' Pairwise rmat_gaussian_kernel between rotation matrices m1 (N, 3, 3) and m2 (M, 3, 3)
+
+    '''
+    return torch.exp(-sqrt(2) * rmat_geodesic_cdist(m1, m2))
+
+
 def rmat_cosine_kernel(m1: torch.Tensor, m2: torch.Tensor) -> torch.Tensor:
     ''' Calculate the cosine kernel between two (batched) rotation matrices
 
@@ -192,17 +308,46 @@ def log_rmat(r_mat: torch.Tensor) -> torch.Tensor:
     return log_r_mat
 
 
-def aa_to_rmat(rot_axis: torch.Tensor, ang: torch.Tensor):
+def rmat_angle(r_mat: torch.Tensor) -> torch.Tensor:
+    '''Rotation angle in [0, pi] of a rotation matrix, without the full log_rmat.
+
+    '''
+    # Same atan2 form as log_rmat, the skew part of a rotation matrix is 2 * sin(angle) * axis
+    s_angle = skew2vec(r_mat - r_mat.transpose(-1, -2)).norm(p=2, dim=-1) / 2
+    c_angle = (torch.einsum('...ii', r_mat) - 1) / 2
+    return torch.atan2(s_angle, c_angle)
+
+
+def aa_to_rmat(rot_axis: torch.Tensor, ang: torch.Tensor, policy=None):
     '''Generates a rotation matrix (3x3) from axis-angle form
 
         `rot_axis`: Axis to rotate around, defined as vector from origin.
         `ang`: rotation angle
+        `policy`: OrthonormalityPolicy to correct with, an SVD of every matrix if None
         '''
     rot_axis_n = rot_axis / rot_axis.norm(p=2, dim=-1, keepdim=True)
     sk_mats = vec2skew(rot_axis_n)
     log_rmats = sk_mats * ang[..., None]
     rot_mat = torch.matrix_exp(log_rmats)
-    return orthogonalise(rot_mat)
+    if policy is None:
+        return orthogonalise(rot_mat)
+    return policy(rot_mat)
+
+
+def rodrigues(unit_axis: torch.Tensor, ang: torch.Tensor) -> torch.Tensor:
+    '''Rotation matrix from a unit axis and angle using Rodrigues' formula
+
+        Cheaper than aa_to_rmat as there's no matrix_exp or SVD,
+        and the result is orthonormal up to rounding for unit axes.
+
+        `unit_axis`: unit length axis to rotate around, shape (..., 3).
+        `ang`: rotation angle, shape (...).
+        '''
+    cos = torch.cos(ang)[..., None, None]
+    sin = torch.sin(ang)[..., None, None]
+    outer = unit_axis[..., :, None] * unit_axis[..., None, :]
+    eye = torch.eye(3, device=unit_axis.device, dtype=unit_axis.dtype)
+    return cos * eye + sin * vec2skew(unit_axis) + (1 - cos) * outer
 
 
 def rmat_to_aa(r_mat) -> Tuple[torch.Tensor, torch.Tensor]:
@@ -251,39 +396,429 @@ def quat_to_rmat(quaternions: torch.Tensor) -> torch.Tensor:
     # reshape to batches x 3 x 3
     return o.reshape(quaternions.shape[:-1] + (3, 3))
 
+
+def rmat_to_quat(r_mat: torch.Tensor) -> torch.Tensor:
+    """
+    Calculates unit quaternions from given rotation matrices
+
+    returns quaternions with real part first and non-negative, shape (..., 4).
+
+    `r_mat`: rotation matrices, shape (..., 3, 3).
+
+    """
+    m = r_mat.flatten(-2, -1)
+    m00, m01, m02, m10, m11, m12, m20, m21, m22 = torch.unbind(m, -1)
+    # 4 * each component squared, we divide through by the largest to stay well conditioned
+    q_abs = torch.sqrt(torch.stack((1 + m00 + m11 + m22,
+                                    1 + m00 - m11 - m22,
+                                    1 - m00 + m11 - m22,
+                                    1 - m00 - m11 + m22,
+                                    ), dim=-1).clamp(min=0.0))
+    candidates = torch.stack(
+        (
+            torch.stack((q_abs[..., 0] ** 2, m21 - m12, m02 - m20, m10 - m01), dim=-1),
+            torch.stack((m21 - m12, q_abs[..., 1] ** 2, m10 + m01, m02 + m20), dim=-1),
+            torch.stack((m02 - m20, m10 + m01, q_abs[..., 2] ** 2, m12 + m21), dim=-1),
+            torch.stack((m10 - m01, m20 + m02, m21 + m12, q_abs[..., 3] ** 2), dim=-1),
+        ),
+        dim=-2,
+    ) / (2 * q_abs[..., None].clamp(min=0.1))
+    best = q_abs.argmax(dim=-1)
+    quat = torch.gather(candidates, -2, best[..., None, None].expand(*best.shape, 1, 4))[..., 0, :]
+    return quat_canonical(quat)
+
+
+def quat_canonical(quat: torch.Tensor) -> torch.Tensor:
+    # q and -q are the same rotation, pick the one with non-negative real part
+    return torch.where(quat[..., :1] < 0, -quat, quat)
+
+
+def quat_conj(quat: torch.Tensor) -> torch.Tensor:
+    return quat * quat.new_tensor([1.0, -1.0, -1.0, -1.0])
+
+
+def quat_mul(q1: torch.Tensor, q2: torch.Tensor) -> torch.Tensor:
+    '''Hamilton product of (batched) quaternions, real part first.
+    Composes rotations in the same order as matrix multiplication.
+    '''
+    r1, i1, j1, k1 = torch.unbind(q1, -1)
+    r2, i2, j2, k2 = torch.unbind(q2, -1)
+    return torch.stack((r1 * r2 - i1 * i2 - j1 * j2 - k1 * k2,
+                        r1 * i2 + i1 * r2 + j1 * k2 - k1 * j2,
+                        r1 * j2 - i1 * k2 + j1 * r2 + k1 * i2,
+                        r1 * k2 + i1 * j2 - j1 * i2 + k1 * r2,
+                        ), dim=-1)
+
+
+def aa_to_quat(unit_axis: torch.Tensor, ang: torch.Tensor) -> torch.Tensor:
+    half = ang[..., None] / 2
+    return torch.cat((torch.cos(half), torch.sin(half) * unit_axis), dim=-1)
+
+
+def skewvec_to_quat(vec: torch.Tensor) -> torch.Tensor:
+    '''Quaternion of the rotation exp(vec2skew(vec)), i.e. axis * angle form
+    '''
+    ang = vec.norm(p=2, dim=-1, keepdim=True)
+    half = ang / 2
+    # sin(half) / ang -> 1/2 as ang -> 0
+    scale = torch.where(ang > 1e-6, torch.sin(half) / ang.clamp(min=1e-6), torch.full_like(ang, 0.5))
+    return torch.cat((torch.cos(half), scale * vec), dim=-1)
+
+
+def quat_pow(quat: torch.Tensor, scalars: torch.Tensor) -> torch.Tensor:
+    '''Quaternion equivalent of so3_scale, scales the angle of rotation (in [0, pi]) by scalars
+    '''
+    quat = quat_canonical(quat)
+    v_norm = quat[..., 1:].norm(p=2, dim=-1, keepdim=True)
+    half = torch.atan2(v_norm, quat[..., :1])
+    scaled_half = half * scalars[..., None]
+    # sin(s * half) / sin(half) -> s as half -> 0
+    scale = torch.where(v_norm > 1e-6,
+                        torch.sin(scaled_half) / v_norm.clamp(min=1e-6),
+                        scalars[..., None].expand_as(v_norm))
+    return torch.cat((torch.cos(scaled_half), scale * quat[..., 1:]), dim=-1)
+
+
+def quat_slerp(quat_a: torch.Tensor, quat_b: torch.Tensor, weight: torch.Tensor) -> torch.Tensor:
+    '''Quaternion equivalent of so3_lerp
+    '''
+    quat_c = quat_mul(quat_conj(quat_a), quat_b)
+    return quat_mul(quat_a, quat_pow(quat_c, weight))
+
+
+# Pairwise forms of kernels, used for kernel blocks rather than broadcasting the kernel over an outer product
+PAIRWISE_KERNELS = {rmat_gaussian_kernel: rmat_gaussian_kernel_cdist}
+
+
+def kernel_matrix(kernel, a: torch.Tensor, b: torch.Tensor) -> torch.Tensor:
+    '''Kernel between every pair of samples of a (N, ...) and b (M, ...), shape (N, M)
+    '''
+    if kernel in PAIRWISE_KERNELS:
+        return PAIRWISE_KERNELS[kernel](a, b)
+    return kernel(a.unsqueeze(1), b.unsqueeze(0))
+
+
+def _kernel_sum(kernel, a: torch.Tensor, b: torch.Tensor) -> torch.Tensor:
+    return kernel_matrix(kernel, a, b).sum(dim=(0, 1))
+
+
+def auto_chunksize(device=torch.device('cpu'), bytes_per_pair=512, mem_fraction=0.25, min_chunk=256):
+    '''Chunk length for outer-product kernel blocks that fits in a fraction of free memory
+
+    `bytes_per_pair` should cover the kernel's temporaries for one pair of samples,
+    the default is generous for the rotation matrix kernels in this file.
+    '''
+    device = torch.device(device)
+    if device.type == 'cuda':
+        free = torch.cuda.get_device_properties(device).total_memory - torch.cuda.memory_reserved(device)
+    else:
+        try:
+            free = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (ValueError, OSError, AttributeError):
+            # Not available on this platform, assume a modest 4GB
+            free = 4 * 1024 ** 3
+    return max(min_chunk, int(sqrt(free * mem_fraction / bytes_per_pair)))
+
+
+class StreamingMMD(object):
+    '''Maximum mean discrepancy between a fixed sample set X and a stream of batches of Y
+
+    Kernel sums are accumulated chunk by chunk, so only one chunksize x chunksize block
+    is in memory at once. Within-set sums only evaluate the upper-triangular blocks,
+    as kernels are symmetric. Y batches can be added with `update` as they are generated,
+    previous Y samples are kept (not their kernel blocks) for the Y-Y sum.
+
+    `chunksize` of None keeps whole sets/batches as single blocks, "auto" picks it from free memory.
+    `X_sum` can be given to reuse a previously computed X-X kernel sum.
+    '''
+
+    def __init__(self, X: torch.Tensor, kernel, chunksize="auto", X_sum=None):
+        self.kernel = kernel
+        if chunksize == "auto":
+            chunksize = auto_chunksize(X.device)
+        self.chunksize = chunksize
+        self.X_chunks = self._split(X)
+        self.l_X = len(X)
+        self.X_sum = X_sum if X_sum is not None else self.self_sum(self.X_chunks)
+        self.X_diag = self.diag_sum(X)
+        self.Y_chunks = []
+        self.l_Y = 0
+        self.Y_sum = 0.0
+        self.Y_diag = 0.0
+        self.XY_sum = 0.0
+
+    def _split(self, Z):
+        if self.chunksize is None:
+            return [Z]
+        return list(torch.tensor_split(Z, list(range(self.chunksize, len(Z), self.chunksize))))
+
+    def self_sum(self, chunks):
+        total = 0.0
+        for i, z1 in enumerate(chunks):
+            total = total + _kernel_sum(self.kernel, z1, z1)
+            for z2 in chunks[i + 1:]:
+                total = total + 2 * _kernel_sum(self.kernel, z1, z2)
+        return total
+
+    def diag_sum(self, Z):
+        return sum(self.kernel(z, z).sum() for z in self._split(Z))
+
+    def update(self, Y_batch: torch.Tensor):
+        self.Y_diag = self.Y_diag + self.diag_sum(Y_batch)
+        for y in self._split(Y_batch):
+            self.Y_sum = self.Y_sum + _kernel_sum(self.kernel, y, y)
+            for y_prev in self.Y_chunks:
+                self.Y_sum = self.Y_sum + 2 * _kernel_sum(self.kernel, y_prev, y)
+            for x in self.X_chunks:
+                self.XY_sum = self.XY_sum + _kernel_sum(self.kernel, x, y)
+            self.Y_chunks.append(y)
+            self.l_Y += len(y)
+        return self
+
+    def result(self):
+        X_ker_mean = (1 / (self.l_X ** 2)) * self.X_sum
+        Y_ker_mean = (1 / (self.l_Y ** 2)) * self.Y_sum
+        outer_mean = (2 / (self.l_X * self.l_Y)) * self.XY_sum
+        return X_ker_mean + Y_ker_mean - outer_mean
+
+    def unbiased_result(self):
+        '''Unbiased estimate of MMD^2, leaving out the k(x, x) terms of the within-set sums
+        '''
+        X_ker_mean = (self.X_sum - self.X_diag) / (self.l_X * (self.l_X - 1))
+        Y_ker_mean = (self.Y_sum - self.Y_diag) / (self.l_Y * (self.l_Y - 1))
+        outer_mean = (2 / (self.l_X * self.l_Y)) * self.XY_sum
+        return X_ker_mean + Y_ker_mean - outer_mean
+
+
 def MMD(X: torch.Tensor, Y: torch.Tensor, kernel, chunksize=None):
     '''
     Calculate maximum mean descrepancy between two sets of tensors using a given kernel
+
+    `chunksize` limits the size of kernel blocks in memory, "auto" picks it from free memory.
     '''
-    l_X = len(X)
-    l_Y = len(Y)
-    maxlen = max(l_X, l_Y)
     # As this involves an outer product, we can end up with matrices too big to fit in ram
-    if chunksize is None or chunksize >= maxlen:
-        X_sum = kernel(X.unsqueeze(0), X.unsqueeze(1)).sum(dim=(0, 1))
-        Y_sum = kernel(Y.unsqueeze(0), Y.unsqueeze(1)).sum(dim=(0, 1))
-        XY_sum = kernel(X.unsqueeze(0), Y.unsqueeze(1)).sum(dim=(0, 1))
+    return StreamingMMD(X, kernel, chunksize=chunksize).update(Y).result()
+
+
+def MMD_unbiased(X: torch.Tensor, Y: torch.Tensor, kernel, chunksize=None):
+    '''
+    Unbiased estimate of the squared maximum mean descrepancy between two sets of tensors
+
+    '''
+    return StreamingMMD(X, kernel, chunksize=chunksize).update(Y).unbiased_result()
+
+
+class MMDPermutationTest(object):
+    '''Permutation test of whether X and Y are samples from the same distribution
+
+    The kernel matrix of the pooled samples is computed once, in symmetric chunks,
+    and kept in memory ((|X| + |Y|)^2 entries, so subsample large sets).
+    Each permutation's unbiased MMD^2 is then a reduction over that matrix,
+    evaluated for a batch of permutations at once as a matrix product with their X-membership masks.
+    '''
+
+    def __init__(self, X: torch.Tensor, Y: torch.Tensor, kernel, chunksize=None):
+        self.l_X = len(X)
+        self.l_Y = len(Y)
+        Z = torch.cat((X, Y))
+        chunks = [Z] if chunksize is None else list(torch.split(Z, chunksize))
+        self.K = torch.empty(len(Z), len(Z), device=Z.device, dtype=Z.dtype)
+        starts = [0]
+        for z in chunks:
+            starts.append(starts[-1] + len(z))
+        for i, z1 in enumerate(chunks):
+            for j in range(i, len(chunks)):
+                block = kernel_matrix(kernel, z1, chunks[j])
+                self.K[starts[i]:starts[i + 1], starts[j]:starts[j + 1]] = block
+                self.K[starts[j]:starts[j + 1], starts[i]:starts[i + 1]] = block.T
+        self.diag = self.K.diagonal()
+        self.row_sums = self.K.sum(dim=-1)
+        self.total = self.row_sums.sum()
+        self.statistic = self.mmd(torch.arange(len(Z), device=Z.device).unsqueeze(0) < self.l_X)[0]
+
+    def mmd(self, in_X: torch.Tensor) -> torch.Tensor:
+        '''Unbiased MMD^2 for a batch of splits of the pooled samples
+
+        `in_X`: bool masks of which samples are in X, shape (batch, |X| + |Y|), each with |X| set.
+        '''
+        m, n = self.l_X, self.l_Y
+        a = in_X.to(self.K.dtype)
+        XX = ((a @ self.K) * a).sum(dim=-1)
+        XZ = a @ self.row_sums
+        YY = self.total - 2 * XZ + XX
+        XY = XZ - XX
+        X_diag = a @ self.diag
+        Y_diag = self.diag.sum() - X_diag
+        return (XX - X_diag) / (m * (m - 1)) + (YY - Y_diag) / (n * (n - 1)) - 2 * XY / (m * n)
+
+    def p_value(self, permutations=500, batch=100, generator=None):
+        '''Fraction of random splits with MMD^2 at least the observed one, counting the observed split
+        '''
+        exceed = 0
+        done = 0
+        while done < permutations:
+            b = min(batch, permutations - done)
+            ranks = torch.rand(b, len(self.K), generator=generator).argsort(dim=-1).to(self.K.device)
+            exceed += (self.mmd(ranks < self.l_X) >= self.statistic).sum().item()
+            done += b
+        return (1 + exceed) / (1 + permutations)
+
+
+def _sorted_projections(Z: torch.Tensor, directions: torch.Tensor, weights=None, use_quat=False):
+    proj = Z @ directions
+    if use_quat:
+        # q and -q are the same rotation, |q . w| is the same for both
+        proj = proj.abs()
+    proj, order = proj.T.sort(dim=-1)
+    if weights is None:
+        return proj, None
+    weights = weights / weights.sum()
+    return proj, weights[order]
+
+
+def _wasserstein_1d(x: torch.Tensor, y: torch.Tensor, x_weights=None, y_weights=None, p=2):
+    '''p-th power of the 1D Wasserstein distance, for rows of sorted values x (P, n) and y (P, m)
+    '''
+    if x_weights is None and y_weights is None and x.shape[-1] == y.shape[-1]:
+        return (x - y).abs().pow(p).mean(dim=-1)
+    # Compare quantile functions, which are constant between the merged cumulative weights
+    if x_weights is None:
+        x_weights = torch.full_like(x, 1 / x.shape[-1])
+    if y_weights is None:
+        y_weights = torch.full_like(y, 1 / y.shape[-1])
+    x_cdf = x_weights.cumsum(dim=-1)
+    y_cdf = y_weights.cumsum(dim=-1)
+    levels, _ = torch.cat((x_cdf, y_cdf), dim=-1).sort(dim=-1)
+    steps = torch.diff(levels, dim=-1, prepend=torch.zeros_like(levels[:, :1]))
+    # Quantiles are taken just below each level, so rounding in the cumsums can't step past the end
+    x_idx = torch.searchsorted(x_cdf, levels - 0.5 * steps).clamp(max=x.shape[-1] - 1)
+    y_idx = torch.searchsorted(y_cdf, levels - 0.5 * steps).clamp(max=y.shape[-1] - 1)
+    diff = x.gather(-1, x_idx) - y.gather(-1, y_idx)
+    return (steps * diff.abs().pow(p)).sum(dim=-1)
+
+
+def sliced_wasserstein(X: torch.Tensor, Y: torch.Tensor, projections=64, p=2, X_weights=None, Y_weights=None,
+                       use_quat=False, batch=16, generator=None) -> torch.Tensor:
+    '''Sliced p-Wasserstein distance between sets of rotation matrices X (n, 3, 3) and Y (m, 3, 3)
+
+    Samples are projected onto random directions, either of the rotation matrices in R^9
+    or of their quaternions, as |q . w| so antipodal quaternions agree.
+    Each projection is then an optimal transport problem on the line, solved by sorting.
+    `X_weights`, `Y_weights` optionally weight the samples, they don't need to be normalised.
+    Projections are processed `batch` at a time, so memory is O(batch * (n + m)).
+    '''
+    dim = 4 if use_quat else 9
+    directions = torch.randn(dim, projections, generator=generator).to(X)
+    directions = directions / directions.norm(dim=0, keepdim=True)
+    if use_quat:
+        X, Y = rmat_to_quat(X), rmat_to_quat(Y)
     else:
-        # If chunksize is set, split X and Y arrays into manageable lengths,
-        splits = list(range(chunksize, maxlen, chunksize))
-        X_split = torch.tensor_split(X, splits)
-        Y_split = torch.tensor_split(Y, splits)
-        # Take outer product kernel function thing and sum each chunk, then sum over them.
-        X_chunk_sums = [kernel(x1.unsqueeze(0), x2.unsqueeze(1)).sum(dim=(0, 1)) for x1, x2 in product(X_split, X_split)]
-        X_sum = sum(X_chunk_sums)
+        X, Y = X.flatten(-2, -1), Y.flatten(-2, -1)
+    total = 0.0
+    for dirs in torch.split(directions, batch, dim=-1):
+        x, x_w = _sorted_projections(X, dirs, X_weights, use_quat)
+        y, y_w = _sorted_projections(Y, dirs, Y_weights, use_quat)
+        total = total + _wasserstein_1d(x, y, x_w, y_w, p=p).sum()
+    return (total / projections) ** (1 / p)
+
+
+def geodesic_gaussian_kernel(angles: torch.Tensor) -> torch.Tensor:
+    '''rmat_gaussian_kernel as a function of the rotation angle between its arguments
+    '''
+    return torch.exp(-sqrt(2) * angles)
 
-        Y_chunk_sums = [kernel(y1.unsqueeze(0), y2.unsqueeze(1)).sum(dim=(0, 1)) for y1, y2 in product(Y_split, Y_split)]
-        Y_sum = sum(Y_chunk_sums)
 
-        XY_chunk_sums = [kernel(x.unsqueeze(0), y.unsqueeze(1)).sum(dim=(0, 1)) for x, y in product(X_split, Y_split)]
-        XY_sum = sum(XY_chunk_sums)
+class SO3RandomFeatures(torch.nn.Module):
+    '''Random feature map for a class function kernel k(angle of m1^T m2) on SO(3)
 
-    X_ker_mean = (1 / (l_X ** 2)) * X_sum
-    Y_ker_mean = (1 / (l_Y ** 2)) * Y_sum
-    outer_mean = (2 / (l_X * l_Y)) * XY_sum
+    The kernel's character expansion k = sum_l a_l chi_l is truncated at max_degree, and
+    h = sum_l sqrt(a_l (2l + 1)) chi_l is tabulated on an angle grid. By Schur orthogonality
+    E_g[h(m1^T g) h(m2^T g)] = sum_l a_l chi_l(m1^T m2) for Haar distributed g,
+    so with num_features Haar samples g_j the features h(m^T g_j) / sqrt(num_features)
+    have inner products approximating the kernel, at the cost of one trace per feature.
+    `tail` is the part of k(0) dropped by the truncation.
+    '''
 
-    return X_ker_mean + Y_ker_mean - outer_mean
+    def __init__(self, num_features=4096, angle_kernel=geodesic_gaussian_kernel, max_degree=64,
+                 grid_size=4096, integration_points=20_000, generator=None):
+        super().__init__()
+        self.num_features = num_features
+        # Character coefficients a_l = int k chi_l dHaar, using chi_l(t) (1 - cos t) = cos(l t) - cos((l + 1) t)
+        angles = torch.linspace(0, pi, integration_points + 1, dtype=torch.float64)
+        degrees = torch.arange(max_degree + 2, dtype=torch.float64)
+        cosines = torch.cos(degrees * angles[:, None])
+        integrand = angle_kernel(angles)[:, None] * (cosines[:, :-1] - cosines[:, 1:])
+        coeffs = torch.trapz(integrand, dx=pi / integration_points, dim=0).clamp(min=0.0) / pi
+        dims = 2 * degrees[:-1] + 1
+        self.tail = (angle_kernel(torch.zeros(1, dtype=torch.float64)) - (coeffs * dims).sum()).item()
+
+        # chi_l(t) = 1 + 2 sum_{m <= l} cos(m t)
+        self.angle_step = pi / (grid_size - 1)
+        grid = torch.linspace(0, pi, grid_size, dtype=torch.float64)
+        chars = 2 * torch.cos(degrees[:-1] * grid[:, None]).cumsum(dim=-1) - 1
+        h_table = chars @ (coeffs * dims).sqrt()
+        self.register_buffer("h_table", h_table.float())
+        haar = quat_to_rmat(torch.randn(num_features, 4, generator=generator, dtype=torch.float64))
+        self.register_buffer("frequencies", haar.flatten(-2, -1).T.float().contiguous())
+
+    def forward(self, rotations: torch.Tensor) -> torch.Tensor:
+        '''Features of rotation matrices (..., 3, 3), returns (..., num_features)
+        '''
+        trace = rotations.flatten(-2, -1) @ self.frequencies
+        angles = torch.acos(((trace - 1) / 2).clamp(-1.0, 1.0))
+        pos = angles / self.angle_step
+        idx = pos.floor().long().clamp(max=len(self.h_table) - 2)
+        features = torch.lerp(self.h_table[idx], self.h_table[idx + 1], pos - idx)
+        return features / sqrt(self.num_features)
+
+    def feature_sum(self, rotations: torch.Tensor, chunksize=4_096) -> torch.Tensor:
+        total = 0.0
+        for chunk in torch.split(rotations, chunksize):
+            total = total + self(chunk).sum(dim=0)
+        return total
+
+
+class RandomFeatureMMD(object):
+    '''Linear time approximation of StreamingMMD using SO3RandomFeatures
+
+    MMD is the squared distance between mean feature vectors, so only the mean
+    of the reference set X is kept; it can be saved and reloaded to skip recomputing it.
+    The truncated part of the kernel's diagonal is added back as tail * (1/|X| + 1/|Y|),
+    the truncation otherwise underestimates MMD by at most 4 * tail.
+    Has the same update/result interface as StreamingMMD, `reset` clears Y for the next comparison.
+    '''
 
+    def __init__(self, X: torch.Tensor, features: SO3RandomFeatures, chunksize=4_096, X_mean=None, l_X=None):
+        self.features = features
+        self.chunksize = chunksize
+        if X_mean is None:
+            X_mean = features.feature_sum(X, chunksize) / len(X)
+            l_X = len(X)
+        self.X_mean = X_mean
+        self.l_X = l_X
+        self.reset()
+
+    def reset(self):
+        self.Y_sum = 0.0
+        self.l_Y = 0
+        return self
+
+    def update(self, Y_batch: torch.Tensor):
+        self.Y_sum = self.Y_sum + self.features.feature_sum(Y_batch, self.chunksize)
+        self.l_Y += len(Y_batch)
+        return self
+
+    def result(self):
+        diff = self.X_mean - self.Y_sum / self.l_Y
+        return diff.pow(2).sum() + self.features.tail * (1 / self.l_X + 1 / self.l_Y)
+
+    def save(self, path):
+        torch.save({"features": self.features, "X_mean": self.X_mean, "l_X": self.l_X}, path)
+
+    @classmethod
+    def load(cls, path, chunksize=4_096, map_location=None):
+        reference = torch.load(path, map_location=map_location)
+        return cls(None, reference["features"], chunksize, X_mean=reference["X_mean"], l_X=reference["l_X"])
 
 
 def Ker_2samp_test(X, Y, kernel, alpha=0.05, max_ker=1, chunksize=None):
@@ -322,28 +857,174 @@ def rmat_dist(input: torch.Tensor, target: torch.Tensor) -> torch.Tensor:
     return out  # Frobenius norm
 
 
+class GeodesicPath(object):
+    '''Geodesic from rot_a to rot_b on SO(3), R(w) = rot_a @ exp(w * log(rot_a^T @ rot_b))
+
+    The relative rotation's axis and angle are found once, so evaluating any number of weights
+    is a single batched Rodrigues' formula, with no log, matrix_exp or SVD per call.
+    For a fixed grid of weights, `precompute` tabulates the path so `lookup` is just indexing.
+    '''
+
+    def __init__(self, rot_a: torch.Tensor, rot_b: torch.Tensor):
+        # Treat rot_b = rot_a @ rot_c
+        # rot_a^-1 @ rot_b = rot_a^-1 @ rot_a @ rot_c = I @ rot_c
+        self.rot_a = rot_a
+        skew_vec = skew2vec(log_rmat(rot_a.transpose(-1, -2) @ rot_b))
+        self.angle = skew_vec.norm(p=2, dim=-1, keepdim=True)
+        # Any axis will do for identical endpoints, where the angle is 0
+        self.axis = torch.where(self.angle > 0, skew_vec / self.angle.clamp(min=1e-12), torch.zeros_like(skew_vec))
+        self.weights = None
+        self.table = None
+
+    def __call__(self, weight: torch.Tensor) -> torch.Tensor:
+        '''Points along the path, weight broadcasting against the endpoints' batch shape with a trailing 1,
+        as in so3_lerp
+        '''
+        i_angle = (weight * self.angle)[..., 0]
+        return self.rot_a @ rodrigues(self.axis, i_angle)
+
+    def precompute(self, weights: torch.Tensor):
+        '''Tabulates the path at a fixed grid of weights (n,), for lookup by index
+
+        Every weight is applied to every pair of endpoints, so the table has shape (n, ..., 3, 3)
+        for endpoints of batch shape (...).
+        '''
+        self.weights = weights
+        # (n, 1, ..., 1), against the endpoints' batch shape and trailing 1
+        self.table = self(weights.reshape((-1,) + (1,) * self.angle.dim()))
+        return self
+
+    def lookup(self, index: torch.Tensor):
+        '''Points at the given indices into the precomputed weight grid, shape index.shape + (..., 3, 3)
+        '''
+        if self.table is None:
+            raise RuntimeError("No weights precomputed for path lookup")
+        return self.table[index]
+
+
+class SE3GeodesicPath(GeodesicPath):
+    '''Path between poses for se3_lerp, a GeodesicPath for rotations and straight line for shifts
+    '''
+
+    def __init__(self, transf_a: AffineT, transf_b: AffineT):
+        super().__init__(transf_a.rot, transf_b.rot)
+        self.shift_a = transf_a.shift
+        self.shift_b = transf_b.shift
+
+    def __call__(self, weight: torch.Tensor) -> AffineT:
+        return AffineT(super().__call__(weight), torch.lerp(self.shift_a, self.shift_b, weight))
+
+
 def so3_lerp(rot_a: torch.Tensor, rot_b: torch.Tensor, weight: torch.Tensor) -> torch.Tensor:
     ''' Weighted interpolation between rot_a and rot_b
 
+    For repeated calls with the same endpoints, keep a GeodesicPath instead.
     '''
-    # Treat rot_b = rot_a @ rot_c
-    # rot_a^-1 @ rot_a = I
-    # rot_a^-1 @ rot_b = rot_a^-1 @ rot_a @ rot_c = I @ rot_c
-    # once we have rot_c, use axis-angle forms to lerp angle
-    rot_c = rot_a.transpose(-1, -2) @ rot_b
-    axis, angle = rmat_to_aa(rot_c)
-    # once we have axis-angle forms, determine intermediate angles.
-    i_angle = weight * angle
-    rot_c_i = aa_to_rmat(axis, i_angle)
-    return rot_a @ rot_c_i
+    return GeodesicPath(rot_a, rot_b)(weight)
+
+def bernstein_basis(weights: torch.Tensor, degree) -> torch.Tensor:
+    '''Bernstein polynomials of a degree at weights (m,), shape (m, degree + 1)
+    '''
+    i = torch.arange(degree + 1, device=weights.device, dtype=weights.dtype)
+    log_comb = torch.lgamma(i.new_tensor(degree + 1.0)) - torch.lgamma(i + 1) - torch.lgamma(degree - i + 1)
+    t = weights[:, None]
+    return torch.exp(log_comb) * t.pow(i) * (1 - t).pow(degree - i)
+
 
 def so3_bezier(*rots, weight):
-    if len(rots) == 2:
-        return so3_lerp(*rots, weight=weight)
-    else:
-        a = so3_bezier(rots[:-1], weight=weight)
-        b = so3_bezier(rots[1:], weight=weight)
-        return so3_lerp(a,b, weight=weight)
+    '''Bezier curve through control rotations at weight, by De Casteljau's algorithm with geodesic lerps
+
+    weight broadcasts as in so3_lerp. Each level lerps all neighbouring pairs in one batch,
+    so n control points take n - 1 batched calls (O(n^2) lerps).
+    '''
+    level = torch.stack(torch.broadcast_tensors(*rots))
+    while len(level) > 1:
+        level = GeodesicPath(level[:-1], level[1:])(weight)
+    return level[0]
+
+
+class SO3Bezier(object):
+    '''Bezier curves on SO(3) with control rotations `rots` (n, ..., 3, 3), for evaluating many weights at once
+
+    Any dimensions after the first are a batch of curves, e.g. one per mode of a multi-modal target.
+    The relative rotations between neighbouring control points are found once, and reused by
+    both the De Casteljau evaluation (__call__) and the cumulative form (`cumulative`).
+    '''
+
+    def __init__(self, rots):
+        if isinstance(rots, (list, tuple)):
+            rots = torch.stack(torch.broadcast_tensors(*rots))
+        if len(rots) < 2:
+            raise RuntimeError(f"Bezier curves need at least 2 control points, got {len(rots)}")
+        self.rots = rots
+        self.degree = len(rots) - 1
+        self.first = GeodesicPath(rots[:-1], rots[1:])
+
+    def _weights(self, weights: torch.Tensor) -> torch.Tensor:
+        # weights (m,) to (m, 1, ..., 1), broadcasting against a leading control point dim, the curve batch and a trailing 1
+        return weights.reshape((-1,) + (1,) * (self.rots.dim() - 1))
+
+    def __call__(self, weights: torch.Tensor) -> torch.Tensor:
+        '''De Casteljau evaluation at weights (m,), returns rotations (m, ..., 3, 3)
+        '''
+        w = self._weights(weights)
+        level = self.first(w)
+        while level.shape[1] > 1:
+            level = GeodesicPath(level[:, :-1], level[:, 1:])(w)
+        return level[:, 0]
+
+    def cumulative(self, weights: torch.Tensor) -> torch.Tensor:
+        '''Cumulative Bernstein form (Kim, Kim & Shin 1995) at weights (m,), returns rotations (m, ..., 3, 3)
+
+        R(t) = R_0 prod_j exp(C_j(t) log(R_{j-1}^T R_j)), with C_j the sum of the Bernstein polynomials from j on.
+        A smooth curve with the same end points and end tangents as __call__, though not the same curve,
+        at O(n) per weight using only the cached relative rotations.
+        '''
+        basis = bernstein_basis(weights, self.degree)
+        cum_basis = basis.flip(-1).cumsum(-1).flip(-1)[:, 1:]
+        cum_basis = cum_basis.reshape(cum_basis.shape + (1,) * (self.rots.dim() - 3))
+        steps = rodrigues(self.first.axis, cum_basis * self.first.angle[..., 0])
+        out = self.rots[0].expand(steps.shape[:1] + self.rots.shape[1:])
+        for j in range(self.degree):
+            out = out @ steps[:, j]
+        return out
+
+    def sample(self, n, cumulative=False, generator=None) -> torch.Tensor:
+        '''n rotations (n, 3, 3) at uniform random weights along randomly chosen curves of the batch
+        '''
+        device = self.rots.device
+        weights = torch.rand(n, generator=generator).to(self.rots)
+        curves = torch.randint(0, self.rots[0, ..., 0, 0].numel(), (n,), generator=generator).to(device)
+        rots = self.cumulative(weights) if cumulative else self(weights)
+        rots = rots.reshape(n, -1, 3, 3)
+        return rots[torch.arange(n, device=device), curves]
+
+
+class SE3Bezier(SO3Bezier):
+    '''Bezier curves of poses `transfs` (n, ...), SO3Bezier for rotations and Bernstein polynomials for shifts
+    '''
+
+    def __init__(self, transfs: AffineT):
+        super().__init__(transfs.rot)
+        self.shifts = transfs.shift
+
+    def _shifts(self, weights: torch.Tensor) -> torch.Tensor:
+        basis = bernstein_basis(weights, self.degree)
+        return torch.einsum('mn,n...->m...', basis, self.shifts)
+
+    def __call__(self, weights: torch.Tensor) -> AffineT:
+        return AffineT(super().__call__(weights), self._shifts(weights))
+
+    def cumulative(self, weights: torch.Tensor) -> AffineT:
+        return AffineT(super().cumulative(weights), self._shifts(weights))
+
+    def sample(self, n, cumulative=False, generator=None) -> AffineT:
+        device = self.rots.device
+        weights = torch.rand(n, generator=generator).to(self.rots)
+        curves = torch.randint(0, self.rots[0, ..., 0, 0].numel(), (n,), generator=generator).to(device)
+        poses = self.cumulative(weights) if cumulative else self(weights)
+        idx = torch.arange(n, device=device)
+        return AffineT(poses.rot.reshape(n, -1, 3, 3)[idx, curves], poses.shift.reshape(n, -1, 3)[idx, curves])
 
 
 def so3_scale(rmat, scalars):
@@ -364,19 +1045,9 @@ def so3_scale(rmat, scalars):
 def se3_lerp(transf_a: AffineT, transf_b: AffineT, weight: torch.Tensor) -> AffineT:
     ''' Weighted interpolation between transf_a and transf_a
 
+    For repeated calls with the same endpoints, keep a SE3GeodesicPath instead.
     '''
-    # Treat rot_b = rot_a @ rot_c
-    # rot_a^-1 @ rot_a = I
-    # rot_a^-1 @ rot_b = rot_a^-1 @ rot_a @ rot_c = I @ rot_c
-    # once we have rot_c, use axis-angle forms to lerp angle
-    rot_a = transf_a.rot
-    rot_b = transf_b.rot
-    rot_lerps = so3_lerp(rot_a, rot_b, weight)
-    shift_a = transf_a.shift
-    shift_b = transf_b.shift
-    shift_lerps = torch.lerp(shift_a, shift_b, weight)
-
-    return AffineT(rot_lerps, shift_lerps)
+    return SE3GeodesicPath(transf_a, transf_b)(weight)
 
 
 def se3_scale(transf: AffineT, scalars) -> AffineT: